@@ -0,0 +1,113 @@
+import contextlib
+import gzip
+import os
+import tarfile
+import tempfile
+import time
+from typing import BinaryIO, Dict, Iterator, Set
+
+from web_compiler.backend import cache
+from web_compiler.backend import linker
+from web_compiler.backend import materialize
+from web_compiler.tracing import tracing
+
+# Entries up to this size are staged in memory before being added to the
+# archive; larger ones spill to a temporary file.
+_SPOOL_SIZE = 1 << 20
+
+
+class TarOutput(linker.Output):
+  """Linker output streaming entries into a gzipped tarball.
+
+  The archive is reproducible: every entry gets the same mtime and neutral
+  ownership, directories are added as they are first needed, and the gzip
+  header carries no name or timestamp. The linker populates resources in a
+  fixed order, so the same inputs produce the same bytes. A compression level
+  of 0 stores the data uncompressed inside the gzip container.
+
+  With dedup, copied files whose content was already archived are recorded as
+  hardlinks to the first copy. Counts and timings of archived and deduplicated
+  files are kept in stats, as for materialize.Materializer.
+  """
+
+  def __init__(self, fileobj: BinaryIO, *, compression_level: int = 6,
+               mtime: int = 0, dedup: bool = False):
+    super().__init__()
+    self._mtime = mtime
+    self._dedup = dedup
+    self._stored: Dict[bytes, str] = dict()
+    self.stats: Dict[str, materialize.StrategyStats] = dict()
+    self._gzip = gzip.GzipFile(filename='', mode='wb', fileobj=fileobj,
+                               compresslevel=compression_level, mtime=mtime)
+    self._tar = tarfile.open(fileobj=self._gzip, mode='w|')
+    self._dirs: Set[str] = set()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, *args):
+    # Not finalized after a failure: a well formed but incomplete archive
+    # would pass for a successful build
+    if exc_type is None:
+      self.close()
+
+  def close(self):
+    with tracing.Span('package'):
+      self._tar.close()
+      self._gzip.close()
+
+  def _info(self, path: str, type: bytes, mode: int) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(path)
+    info.type = type
+    info.mode = mode
+    info.mtime = self._mtime
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    return info
+
+  def _arcname(self, path: str) -> str:
+    path = os.path.normpath(path).lstrip('/')
+    parent = os.path.dirname(path)
+    missing = []
+    while parent and parent not in self._dirs:
+      missing.append(parent)
+      parent = os.path.dirname(parent)
+    for d in reversed(missing):
+      self._tar.addfile(self._info(d, tarfile.DIRTYPE, 0o755))
+      self._dirs.add(d)
+    return path
+
+  def _add(self, path: str, f: BinaryIO, size: int):
+    info = self._info(self._arcname(path), tarfile.REGTYPE, 0o644)
+    info.size = size
+    self._tar.addfile(info, f)
+
+  @contextlib.contextmanager
+  def open(self, path: str) -> Iterator[BinaryIO]:
+    with tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE) as f:
+      yield f
+      size = f.tell()
+      f.seek(0)
+      self._add(path, f, size)
+
+  def copy_file(self, src: str, path: str):
+    start = time.perf_counter()
+    digest = cache.HashFile(src) if self._dedup else None
+    first = self._stored.get(digest)
+    if first is not None:
+      info = self._info(self._arcname(path), tarfile.LNKTYPE, 0o644)
+      info.linkname = first
+      self._tar.addfile(info)
+      materialize.Record(self.stats, 'dedup', os.stat(src).st_size, 0, start)
+      return
+    with open(src, 'rb') as f:
+      size = os.fstat(f.fileno()).st_size
+      self._add(path, f, size)
+    if digest is not None:
+      self._stored[digest] = os.path.normpath(path).lstrip('/')
+    materialize.Record(self.stats, 'archive', size, size, start)
+
+  def symlink(self, target: str, path: str):
+    info = self._info(self._arcname(path), tarfile.SYMTYPE, 0o777)
+    info.linkname = target
+    self._tar.addfile(info)
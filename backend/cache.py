@@ -0,0 +1,124 @@
+import concurrent.futures
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+
+def HashFile(path: str) -> bytes:
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 16), b''):
+      h.update(chunk)
+  return h.digest()
+
+
+class FileHasher(object):
+  """Hashes files with HashFile, in parallel, remembering the digests.
+
+  A digest is reused for as long as the file keeps the size and mtime it had
+  when it was hashed, so a hasher that lives across builds (in a persistent
+  worker, say) does not read unchanged files again. hashlib releases the GIL
+  while hashing, so threads hash files concurrently.
+  """
+
+  def __init__(self, *, max_workers: Optional[int] = None):
+    super().__init__()
+    self._max_workers = max_workers
+    self._lock = threading.Lock()
+    self._digests: Dict[str, Tuple[Tuple[int, int], bytes]] = dict()
+
+  def hash_files(self, paths: Iterable[str]) -> Dict[str, bytes]:
+    digests = dict()
+    todo = []
+    for path in set(paths):
+      st = os.stat(path)
+      stamp = (st.st_size, st.st_mtime_ns)
+      with self._lock:
+        entry = self._digests.get(path)
+      if entry is not None and entry[0] == stamp:
+        digests[path] = entry[1]
+      else:
+        todo.append((path, stamp))
+    if len(todo) > 1:
+      with concurrent.futures.ThreadPoolExecutor(self._max_workers) as pool:
+        hashed = list(pool.map(HashFile, [path for path, _ in todo]))
+    else:
+      hashed = [HashFile(path) for path, _ in todo]
+    with self._lock:
+      for (path, stamp), digest in zip(todo, hashed):
+        self._digests[path] = (stamp, digest)
+        digests[path] = digest
+    return digests
+
+
+class Cache(object):
+  """Persistent content-addressed store for build products.
+
+  Entries are pickled values stored under the hex digest of their key parts.
+  Every lookup refreshes the entry's mtime, and evict() removes the least
+  recently used entries until the store fits in max_bytes. Writes go through
+  a temporary file and an atomic rename, so several processes can share one
+  cache directory.
+  """
+
+  def __init__(self, root: str, *, max_bytes: int, salt: bytes = b''):
+    super().__init__()
+    self._root = root
+    self._max_bytes = max_bytes
+    self._salt = salt
+
+  def key(self, *parts: bytes) -> str:
+    h = hashlib.sha256()
+    for part in (self._salt,) + parts:
+      h.update(len(part).to_bytes(8, 'little'))
+      h.update(part)
+    return h.hexdigest()
+
+  def _path(self, key: str) -> str:
+    return os.path.join(self._root, key[:2], key)
+
+  def get(self, key: str) -> Optional[Any]:
+    path = self._path(key)
+    try:
+      with open(path, 'rb') as f:
+        value = pickle.load(f)
+      os.utime(path)
+    except (OSError, EOFError, pickle.UnpicklingError):
+      return None
+    return value
+
+  def put(self, key: str, value: Any):
+    path = self._path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(tmp, path)
+    except BaseException:
+      os.unlink(tmp)
+      raise
+
+  def _entries(self) -> Iterable[os.DirEntry]:
+    for shard in os.scandir(self._root):
+      if shard.is_dir():
+        yield from (e for e in os.scandir(shard.path)
+                    if not e.name.startswith('.tmp-'))
+
+  def evict(self):
+    if not os.path.isdir(self._root):
+      return
+    entries = [(e.stat().st_mtime, e.stat().st_size, e.path)
+               for e in self._entries()]
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total <= self._max_bytes:
+        break
+      try:
+        os.unlink(path)
+      except FileNotFoundError:
+        pass
+      total -= size
@@ -0,0 +1,96 @@
+import collections.abc
+import sys
+import weakref
+from typing import Any, Hashable, Iterable, Iterator, Mapping, Tuple, Union
+
+
+class Node(object):
+  """Base of the compact IR node types.
+
+  Subclasses list their fields in __slots__, in constructor order. Nodes
+  compare by type and fields like the NamedTuples they replace, and pickle by
+  calling the constructor again so that unpickled nodes are interned too.
+  """
+  __slots__ = ()
+
+  def _fields(self) -> Tuple[Any, ...]:
+    return tuple(getattr(self, f) for f in self.__slots__)
+
+  def __eq__(self, other):
+    if type(self) is not type(other):
+      return NotImplemented
+    return self._fields() == other._fields()
+
+  __hash__ = None
+
+  def __repr__(self):
+    fields = ', '.join(f'{f}={getattr(self, f)!r}' for f in self.__slots__)
+    return f'{type(self).__name__}({fields})'
+
+  def __reduce__(self):
+    return (type(self), self._fields())
+
+
+def Intern(s: Any) -> Any:
+  """Intern strings; other values are returned unchanged."""
+  if type(s) is str:
+    return sys.intern(s)
+  return s
+
+
+class FrozenAttrs(collections.abc.Mapping):
+  """Immutable attribute map, shared between all nodes with equal attributes.
+
+  Get instances from FreezeAttrs. items() and values() return tuples, which
+  unlike dict views are reversible.
+  """
+  __slots__ = ('_items', '__weakref__')
+
+  def __init__(self, items: Tuple[Tuple[str, Hashable], ...]):
+    self._items = items
+
+  def __getitem__(self, key):
+    for k, v in self._items:
+      if k == key:
+        return v
+    raise KeyError(key)
+
+  def __iter__(self) -> Iterator[str]:
+    return (k for k, _ in self._items)
+
+  def __len__(self):
+    return len(self._items)
+
+  def items(self) -> Tuple[Tuple[str, Hashable], ...]:
+    return self._items
+
+  def values(self) -> Tuple[Hashable, ...]:
+    return tuple(v for _, v in self._items)
+
+  def __repr__(self):
+    return repr(dict(self._items))
+
+  def __reduce__(self):
+    return (FreezeAttrs, (dict(self._items),))
+
+
+# Live attribute maps by content. Maps are dropped once no node uses them.
+_attrs_table: 'weakref.WeakValueDictionary[Tuple, FrozenAttrs]' = (
+  weakref.WeakValueDictionary())
+
+
+def FreezeAttrs(attrs: Union[Mapping[str, Hashable], None]) -> FrozenAttrs:
+  if isinstance(attrs, FrozenAttrs):
+    return attrs
+  items = tuple((Intern(k), Intern(v)) for k, v in (attrs or {}).items())
+  frozen = _attrs_table.get(items)
+  if frozen is None:
+    frozen = FrozenAttrs(items)
+    _attrs_table[items] = frozen
+  return frozen
+
+
+def Children(parts: Iterable[Any]) -> Tuple[Any, ...]:
+  if type(parts) is tuple:
+    return parts
+  return tuple(parts)
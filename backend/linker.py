@@ -1,23 +1,109 @@
 import abc
+import base64
+import mimetypes
 import os
-import shutil
-from typing import Callable, Dict, NamedTuple, Set
+import urllib.parse
+from typing import BinaryIO, Callable, ContextManager, Dict, Mapping, NamedTuple, Optional, Set, Union
+
+from web_compiler.backend import cache
+from web_compiler.backend import materialize
+from web_compiler.tracing import tracing
 
 
 class Reference(NamedTuple):
   src_url: str
 
 
+class Embed(NamedTuple):
+  """A reference used where the content it refers to may be embedded instead.
+
+  An image's src or a stylesheet link's href, say. A Linker that inlines small
+  resources writes such a use as a data: URI, and the resource itself is only
+  written if something else refers to it.
+  """
+  ref: Reference
+
+
+class Stamp(NamedTuple):
+  """A placeholder for a value that changes from build to build.
+
+  The build date, say. Pages can be rendered with placeholders, so that they
+  depend on their documents alone and can be cached across builds, and the
+  Linker writes the value it was given for key in their place.
+  """
+  key: str
+
+
 class Resource(abc.ABC):
 
   @abc.abstractmethod
-  def get_references(self) -> Set[Reference]:
+  def get_references(self) -> Set[Union[Reference, Embed]]:
     pass
 
   @abc.abstractmethod
   def populate_fs(self, path: str, linker: 'Linker'):
     pass
 
+  def content_file(self) -> Optional[str]:
+    """The file whose content the resource outputs unchanged, if any.
+
+    Resources with one can be given fingerprinted output names.
+    """
+    return None
+
+
+class Output(abc.ABC):
+  """Destination for the files a Linker produces.
+
+  Paths are the ones given to Resource.populate_fs, i.e. output paths joined
+  onto the linker's fs_root. Implementations create parent directories as
+  needed.
+  """
+
+  @abc.abstractmethod
+  def open(self, path: str) -> ContextManager[BinaryIO]:
+    """Open a new regular file for writing."""
+    pass
+
+  @abc.abstractmethod
+  def copy_file(self, src: str, path: str):
+    pass
+
+  @abc.abstractmethod
+  def symlink(self, target: str, path: str):
+    pass
+
+
+class DirectoryOutput(Output):
+  """Writes files into the local filesystem.
+
+  With replace, files already at an output path are removed before it is
+  written, so that a tree can be populated again over a previous build.
+  """
+
+  def __init__(self, materializer: Optional[materialize.Materializer] = None,
+               *, replace: bool = False):
+    super().__init__()
+    self.materializer = materializer or materialize.Materializer()
+    self._replace = replace
+
+  def _prepare(self, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if self._replace and os.path.lexists(path):
+      os.unlink(path)
+
+  def open(self, path: str) -> ContextManager[BinaryIO]:
+    self._prepare(path)
+    return open(path, 'wb')
+
+  def copy_file(self, src: str, path: str):
+    self._prepare(path)
+    self.materializer.materialize(src, path)
+
+  def symlink(self, target: str, path: str):
+    self._prepare(path)
+    os.symlink(target, path)
+
 
 class StaticResource(Resource):
 
@@ -28,8 +114,11 @@ class StaticResource(Resource):
   def get_references(self) -> Set[Reference]:
     return set()
 
-  def populate_fs(self, path: str, _: 'Linker'):
-    shutil.copyfile(self.path, path)
+  def populate_fs(self, path: str, linker: 'Linker'):
+    linker.output.copy_file(self.path, path)
+
+  def content_file(self) -> Optional[str]:
+    return self.path
 
 
 class LinkResource(Resource):
@@ -44,14 +133,62 @@ class LinkResource(Resource):
   def populate_fs(self, path: str, linker: 'Linker'):
     real = linker.resolve(self.ref, absolute=True)
     real_rel = os.path.relpath(real, os.path.dirname(path))
-    os.symlink(real_rel, path)
+    linker.output.symlink(real_rel, path)
+
+
+# Number of hex digits of a content hash put in a fingerprinted name
+_FINGERPRINT_LENGTH = 8
+
+# Characters left as they are in percent-encoded data: URIs
+_DATA_URI_SAFE = "/:;,=+()!*'@?"
+
+
+def DataURI(path: str) -> Optional[str]:
+  """Encode a file as a data: URI, or return None if its type is unknown.
+
+  Files are percent-encoded or base64-encoded, whichever is shorter; text like
+  SVG and CSS is usually shorter percent-encoded.
+  """
+  mime_type, encoding = mimetypes.guess_type(path)
+  if mime_type is None or encoding is not None:
+    return None
+  with open(path, 'rb') as f:
+    data = f.read()
+  quoted = f'data:{mime_type},' + urllib.parse.quote(data, safe=_DATA_URI_SAFE)
+  b64 = f'data:{mime_type};base64,' + base64.b64encode(data).decode('ascii')
+  return min(quoted, b64, key=len)
 
 
 class Linker(object):
+  """Maps references to output paths and writes the resources they reach.
+
+  With fingerprint, link names each resource that has a content_file after a
+  hash of that file's content (style.css becomes style.3f9a1c2e.css), so the
+  file can be served as immutable. References resolve to the fingerprinted
+  names. Files are hashed with hasher, which defaults to a new FileHasher.
+
+  With inline_max_bytes, each Embed of a resource whose content file is no
+  larger than that is written as a data: URI, and the resource drops out of
+  the closure unless it is also referred to in another way. Each resource is
+  encoded once per Linker.
+
+  Stamps are written as their values in stamps.
+  """
 
-  def __init__(self, fs_root: str):
+  def __init__(self, fs_root: str = '', *, output: Optional[Output] = None,
+               fingerprint: bool = False,
+               hasher: Optional[cache.FileHasher] = None,
+               inline_max_bytes: int = 0,
+               stamps: Optional[Mapping[str, str]] = None):
     super().__init__()
     self._fs_root = fs_root
+    self.output = output or DirectoryOutput()
+    self._fingerprint = fingerprint
+    self._hasher = hasher or cache.FileHasher()
+    self._inline_max_bytes = inline_max_bytes
+    self._data_uris: Dict[Reference, Optional[str]] = dict()
+    self._fingerprinted: Set[Reference] = set()
+    self._stamps = stamps or {}
     self._resources: Dict[Reference, Resource] = dict()
     self._link_map: Dict[Reference, str] = dict()
     self._reverse_link_map: Dict[str, Reference] = dict()
@@ -64,24 +201,108 @@ class Linker(object):
     self._link_map[ref] = out
     self._reverse_link_map[out] = ref
 
+  def replace_resource(self, ref: Reference, resource: Resource):
+    """Swap the resource behind ref, keeping its output path."""
+    assert ref in self._resources
+    self._resources[ref] = resource
+
   def resolve(self, ref: Reference, *, absolute: bool = False) -> str:
     if absolute:
       return os.path.join(self._fs_root, self._link_map[ref])
     else:
       return self._link_map[ref]
 
-  def link(self, entries: Set[Reference]):
+  def _data_uri(self, ref: Reference) -> Optional[str]:
+    """The data: URI embeds of ref are written as, if ref is inlined."""
+    try:
+      return self._data_uris[ref]
+    except KeyError:
+      pass
+    uri = None
+    path = self._resources[ref].content_file()
+    if (path is not None and
+        os.path.getsize(path) <= self._inline_max_bytes):
+      with tracing.Span('inline', src_url=ref.src_url):
+        uri = DataURI(path)
+    self._data_uris[ref] = uri
+    return uri
+
+  def inlined(self, ref: Reference) -> bool:
+    """Whether embeds of ref are written as data: URIs."""
+    return bool(self._inline_max_bytes) and self._data_uri(ref) is not None
+
+  def url(self, item: Union[Reference, Embed]) -> str:
+    """The URL a page refers to item by."""
+    if isinstance(item, Embed):
+      if self.inlined(item.ref):
+        return self._data_uri(item.ref)
+      item = item.ref
+    return f'/{self.resolve(item)}'
+
+  def stamp(self, item: Stamp) -> str:
+    try:
+      return self._stamps[item.key]
+    except KeyError:
+      raise ValueError(f'No value for build stamp {item.key!r}') from None
+
+  def closure(self, entries: Set[Reference]) -> Set[Reference]:
+    """Find the references reachable from entries, including entries.
+
+    Resources that are only embedded, and inlined where they are, are left
+    out, since nothing needs to be written for them.
+    """
     frontier: Set[Reference] = set(entries)
     closure: Set[Reference] = set()
-    while frontier:
-      new_frontier: Set[Reference] = set()
-      for ref in frontier:
-        res = self._resources[ref]
-        new_frontier |= set(res.get_references())
-      closure |= frontier
-      frontier = new_frontier - closure
-    for ref in closure:
+    with tracing.Span('closure'):
+      while frontier:
+        new_frontier: Set[Reference] = set()
+        for ref in frontier:
+          res = self._resources[ref]
+          with tracing.Span('get_references', src_url=ref.src_url):
+            for item in res.get_references():
+              if isinstance(item, Embed):
+                if self.inlined(item.ref):
+                  continue
+                item = item.ref
+              new_frontier.add(item)
+        closure |= frontier
+        frontier = new_frontier - closure
+    return closure
+
+  def fingerprint(self, refs: Set[Reference]):
+    """Rename the outputs of those refs that have content files by content."""
+    files = dict()
+    for ref in refs:
+      path = self._resources[ref].content_file()
+      if path is not None:
+        files[ref] = path
+    with tracing.Span('fingerprint'):
+      digests = self._hasher.hash_files(files.values())
+    for ref, path in files.items():
+      out = self._link_map[ref]
+      base, ext = os.path.splitext(out)
+      fingerprinted = (
+        f'{base}.{digests[path].hex()[:_FINGERPRINT_LENGTH]}{ext}')
+      assert fingerprinted not in self._reverse_link_map
+      del self._reverse_link_map[out]
+      self._link_map[ref] = fingerprinted
+      self._reverse_link_map[fingerprinted] = ref
+      self._fingerprinted.add(ref)
+
+  def fingerprinted(self) -> Set[str]:
+    """The absolute output paths of the fingerprinted resources."""
+    return {self.resolve(ref, absolute=True) for ref in self._fingerprinted}
+
+  def populate(self, refs: Set[Reference]):
+    # Populate in a fixed order so that archive outputs are reproducible
+    for ref in sorted(refs, key=self.resolve):
       abspath = self.resolve(ref, absolute=True)
-      os.makedirs(os.path.dirname(abspath), exist_ok=True)
       res = self._resources[ref]
-      res.populate_fs(abspath, self)
+      with tracing.Span('populate_fs', src_url=ref.src_url, path=abspath):
+        res.populate_fs(abspath, self)
+
+  def link(self, entries: Set[Reference]):
+    closure = self.closure(entries)
+    if self._fingerprint:
+      self.fingerprint(closure)
+    self.populate(closure)
@@ -0,0 +1,154 @@
+import errno
+import fcntl
+import os
+import shutil
+import time
+from typing import Callable, Dict, List, NamedTuple
+
+from web_compiler.backend import cache
+
+# From linux/fs.h
+_FICLONE = 0x40049409
+
+# Errors meaning a strategy does not apply to this pair of files, as opposed
+# to the copy having failed
+_UNSUPPORTED = frozenset([
+  errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOSYS, errno.ENOTSUP,
+  errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.EMLINK,
+])
+
+
+def _Hardlink(src: str, dst: str):
+  os.link(src, dst)
+
+
+def _Reflink(src: str, dst: str):
+  with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+    try:
+      fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+    except OSError:
+      fdst.close()
+      os.unlink(dst)
+      raise
+
+
+def _CopyLoop(copy: Callable[[int, int, int], int], src: str, dst: str):
+  with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+    remaining = os.fstat(fsrc.fileno()).st_size
+    try:
+      while remaining > 0:
+        n = copy(fsrc.fileno(), fdst.fileno(), remaining)
+        if n == 0:
+          break
+        remaining -= n
+    except OSError:
+      fdst.close()
+      os.unlink(dst)
+      raise
+
+
+def _CopyRange(src: str, dst: str):
+  _CopyLoop(lambda i, o, n: os.copy_file_range(i, o, n), src, dst)
+
+
+def _SendFile(src: str, dst: str):
+  _CopyLoop(lambda i, o, n: os.sendfile(o, i, None, n), src, dst)
+
+
+def _Copy(src: str, dst: str):
+  shutil.copyfile(src, dst)
+
+
+# Strategies in order of preference. Each falls back to the ones after it
+# when it does not apply (e.g. no reflink support on the filesystem).
+_FALLBACKS = ['reflink', 'copy_range', 'sendfile', 'copy']
+_STRATEGIES: Dict[str, Callable[[str, str], None]] = {
+  'hardlink': _Hardlink,
+  'reflink': _Reflink,
+  'copy_range': _CopyRange,
+  'sendfile': _SendFile,
+  'copy': _Copy,
+}
+
+# 'auto' never hardlinks, since a hardlink aliases the source file
+STRATEGIES = ['auto'] + list(_STRATEGIES)
+
+
+def _Chain(strategy: str) -> List[str]:
+  if strategy == 'auto':
+    return _FALLBACKS
+  elif strategy == 'hardlink':
+    return ['hardlink'] + _FALLBACKS
+  else:
+    return _FALLBACKS[_FALLBACKS.index(strategy):]
+
+
+class StrategyStats(NamedTuple):
+  files: int
+  bytes: int
+  stored_bytes: int
+  seconds: float
+
+  @property
+  def throughput(self) -> float:
+    """Bytes materialized per second."""
+    return self.bytes / self.seconds if self.seconds else 0.0
+
+
+def Record(stats: Dict[str, StrategyStats], strategy: str, size: int,
+           stored: int, start: float):
+  """Account one file materialized since time.perf_counter() was start."""
+  old = stats.get(strategy, StrategyStats(0, 0, 0, 0.0))
+  stats[strategy] = StrategyStats(
+    files=old.files + 1, bytes=old.bytes + size,
+    stored_bytes=old.stored_bytes + stored,
+    seconds=old.seconds + time.perf_counter() - start)
+
+
+class Materializer(object):
+  """Places copies of static files in the output tree.
+
+  Files are materialized with the requested strategy, falling back to a plain
+  copy where the filesystem does not support it. With dedup, files with the
+  same content are stored once and later ones are hardlinked to the first.
+  Per-strategy counts, timings and the bytes newly stored on disk (zero for
+  links and reflinks) are kept in stats.
+  """
+
+  def __init__(self, strategy: str = 'auto', *, dedup: bool = False):
+    super().__init__()
+    if strategy not in STRATEGIES:
+      raise ValueError(f'Unknown materialization strategy {strategy}')
+    self._chain = _Chain(strategy)
+    self._dedup = dedup
+    self._stored: Dict[bytes, str] = dict()
+    self.stats: Dict[str, StrategyStats] = dict()
+
+  def materialize(self, src: str, dst: str):
+    start = time.perf_counter()
+    size = os.stat(src).st_size
+    digest = None
+    if self._dedup:
+      digest = cache.HashFile(src)
+      first = self._stored.get(digest)
+      if first is not None:
+        try:
+          os.link(first, dst)
+          Record(self.stats, 'dedup', size, 0, start)
+          return
+        except OSError as e:
+          if e.errno not in _UNSUPPORTED:
+            raise
+    for strategy in self._chain:
+      try:
+        _STRATEGIES[strategy](src, dst)
+      except OSError as e:
+        if e.errno not in _UNSUPPORTED:
+          raise
+        continue
+      stored = size if strategy in ('copy_range', 'sendfile', 'copy') else 0
+      Record(self.stats, strategy, size, stored, start)
+      if digest is not None:
+        self._stored[digest] = dst
+      return
+    raise AssertionError('copy strategy should not fall through')
@@ -0,0 +1,163 @@
+import contextlib
+import gzip
+import io
+import re
+from typing import BinaryIO, Dict, Iterator, NamedTuple, Optional
+
+from web_compiler.backend import linker
+from web_compiler.tracing import tracing
+
+# Elements whose content is rendered with its whitespace intact
+_PRESERVE = frozenset(['pre', 'textarea', 'script', 'style'])
+
+# Elements around which whitespace is not rendered
+_BLOCK = frozenset([
+  '!doctype', 'address', 'article', 'aside', 'blockquote', 'body', 'dd', 'div',
+  'dl', 'dt', 'fieldset', 'figcaption', 'figure', 'footer', 'form', 'h1', 'h2',
+  'h3', 'h4', 'h5', 'h6', 'head', 'header', 'hr', 'html', 'li', 'link',
+  'main', 'meta', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'tbody', 'td',
+  'tfoot', 'th', 'thead', 'title', 'tr', 'ul',
+])
+
+# End tags that HTML never needs: those of void elements, which have no
+# content, and the document's outermost elements
+_REDUNDANT_END = frozenset([
+  'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+  'source', 'track', 'wbr', 'head', 'body', 'html',
+])
+
+_TAG = re.compile(
+  r'''<(/?)(!DOCTYPE|[A-Za-z][A-Za-z0-9-]*)((?:[^>"']|"[^"]*"|'[^']*')*)>''')
+# HTML's ASCII whitespace. Python's \s also matches no-break and other
+# Unicode spaces, which are text and must be kept.
+_WS = r' \t\n\f\r'
+_ATTR = re.compile(rf'''[{_WS}]+([^{_WS}=>]+)(?:="([^"]*)")?''')
+_UNQUOTED_VALUE = re.compile(rf'''[^{_WS}"'=<>`]+''')
+_SPACE = re.compile(rf'[{_WS}]+')
+
+# File types written with a precompressed sibling
+_COMPRESSIBLE = ('.html', '.css', '.svg')
+
+
+def _Attr(m: re.Match) -> str:
+  key, value = m.groups()
+  if value is None:
+    return f' {key}'
+  if _UNQUOTED_VALUE.fullmatch(value):
+    return f' {key}={value}'
+  return f' {key}="{value}"'
+
+
+def MinifyHTML(html: str) -> str:
+  """Minify HTML as written by the backend.
+
+  Outside of <pre> and similar elements, runs of whitespace are collapsed to
+  one space, and whitespace next to block-level tags, which browsers do not
+  render, is dropped. End tags of void elements and of <html>, <head> and
+  <body> are dropped, as are quotes around attribute values that do not need
+  them.
+  """
+  parts = []
+  preserve = 0
+  after_block = True
+  pos = 0
+  for m in _TAG.finditer(html):
+    closing, name, attrs = m.groups()
+    name = name.lower()
+    block = name in _BLOCK
+    text = html[pos:m.start()]
+    pos = m.end()
+    if preserve:
+      parts.append(text)
+    elif text:
+      text = _SPACE.sub(' ', text)
+      if after_block:
+        text = text.lstrip(' ')
+      if block:
+        text = text.rstrip(' ')
+      parts.append(text)
+    if closing:
+      if name in _PRESERVE:
+        preserve -= 1
+      if name not in _REDUNDANT_END:
+        parts.append(m.group())
+    else:
+      if name in _PRESERVE:
+        preserve += 1
+      parts.append(f'<{m.group(2)}{_ATTR.sub(_Attr, attrs)}>')
+    after_block = block
+  text = html[pos:]
+  if preserve:
+    parts.append(text)
+  else:
+    parts.append(_SPACE.sub(' ', text).strip(' '))
+  return ''.join(parts)
+
+
+class PageStats(NamedTuple):
+  """Sizes of one page as rendered, minified and precompressed."""
+  bytes_in: int
+  bytes_out: int
+  gzip_bytes: Optional[int]
+
+  @property
+  def bytes_saved(self) -> int:
+    return self.bytes_in - self.bytes_out
+
+
+class OptimizingOutput(linker.Output):
+  """Linker output that optimizes files on their way to another output.
+
+  With minify, HTML pages are minified with MinifyHTML. With precompress,
+  each HTML, CSS and SVG file also gets a gzipped sibling with a .gz suffix,
+  for servers that serve those in place of compressing on every request, like
+  nginx with gzip_static. Siblings are always written, even when they are not
+  smaller, so that a symlink to a page can be mirrored by a symlink to its
+  sibling. The sizes of each page are kept in stats.
+  """
+
+  def __init__(self, output: linker.Output, *, minify: bool = True,
+               precompress: bool = False):
+    super().__init__()
+    self._output = output
+    self._minify = minify
+    self._precompress = precompress
+    self.stats: Dict[str, PageStats] = dict()
+
+  def _write_gzip(self, path: str, data: bytes) -> int:
+    # Reproducible: no name and a fixed mtime in the gzip header
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    with self._output.open(path + '.gz') as f:
+      f.write(compressed)
+    return len(compressed)
+
+  @contextlib.contextmanager
+  def open(self, path: str) -> Iterator[BinaryIO]:
+    buffer = io.BytesIO()
+    yield buffer
+    data = buffer.getvalue()
+    bytes_in = len(data)
+    html = path.endswith('.html')
+    if html and self._minify:
+      data = MinifyHTML(data.decode('utf-8')).encode('utf-8')
+    with self._output.open(path) as f:
+      f.write(data)
+    gzip_bytes = None
+    if self._precompress and path.endswith(_COMPRESSIBLE):
+      gzip_bytes = self._write_gzip(path, data)
+    if html:
+      self.stats[path] = PageStats(
+        bytes_in=bytes_in, bytes_out=len(data), gzip_bytes=gzip_bytes)
+      tracing.Annotate(bytes_saved=bytes_in - len(data))
+
+  def copy_file(self, src: str, path: str):
+    self._output.copy_file(src, path)
+    if self._precompress and path.endswith(_COMPRESSIBLE):
+      with open(src, 'rb') as f:
+        self._write_gzip(path, f.read())
+
+  def symlink(self, target: str, path: str):
+    self._output.symlink(target, path)
+    if (self._precompress and path.endswith(_COMPRESSIBLE)
+        and target.endswith(_COMPRESSIBLE)):
+      self._output.symlink(target + '.gz', path + '.gz')
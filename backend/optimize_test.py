@@ -0,0 +1,25 @@
+from absl.testing import absltest
+
+from web_compiler.backend import optimize
+
+
+class MinifyHTMLTest(absltest.TestCase):
+
+  def test_collapses_ascii_whitespace(self):
+    self.assertEqual(
+      optimize.MinifyHTML('<p>a \n\t\f\r b</p>\n<p>c</p>'),
+      '<p>a b</p><p>c</p>')
+
+  def test_keeps_unicode_spaces(self):
+    self.assertEqual(
+      optimize.MinifyHTML('<p>100\xa0km and a　b</p>'),
+      '<p>100\xa0km and a　b</p>')
+
+  def test_attribute_values_keep_unicode_spaces(self):
+    self.assertEqual(
+      optimize.MinifyHTML('<a  href="a\xa0b"\n title="c d">e</a>'),
+      '<a href=a\xa0b title="c d">e</a>')
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -1,19 +1,182 @@
-from typing import Dict, List, NamedTuple, Set, Text, Union
+import codecs
+import html
+import io
+import mmap
+from typing import FrozenSet, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Set, Text, Tuple, Union
 
+from web_compiler.backend import compact
 from web_compiler.backend import linker
+from web_compiler.tracing import tracing
 
 
-class MixedContent(NamedTuple):
-  parts: List['Fragment']
+class MixedContent(compact.Node):
+  __slots__ = ('parts',)
+  parts: Sequence['Fragment']
 
+  def __init__(self, parts):
+    self.parts = compact.Children(parts)
 
-class HTMLNode(NamedTuple):
+
+class HTMLNode(compact.Node):
+  __slots__ = ('tag', 'attrs', 'content')
   tag: Text
-  attrs: Dict[Text, Union[Text, linker.Reference]]
+  attrs: Mapping[Text, Union[Text, linker.Reference, linker.Embed,
+                             linker.Stamp]]
   content: MixedContent
 
+  def __init__(self, tag, attrs, content):
+    self.tag = compact.Intern(tag)
+    self.attrs = compact.FreezeAttrs(attrs)
+    self.content = content
+
+
+# Bytes of a TextFile decoded and escaped at a time
+_TEXT_CHUNK_SIZE = 1 << 16
+
+
+class TextFile(compact.Node):
+  """Text in a file, from byte start to end, written escaped as HTML.
+
+  The file is only read when the page is written, through an mmap and one
+  chunk at a time, so the size of the text does not affect the memory needed
+  to render or write it. Newlines are translated as a text-mode file would.
+  """
+  __slots__ = ('path', 'start', 'end', 'encoding')
+  path: Text
+  start: int
+  end: int
+  encoding: Text
+
+  def __init__(self, path, start, end, encoding):
+    self.path = path
+    self.start = start
+    self.end = end
+    self.encoding = compact.Intern(encoding)
+
+  def chunks(self) -> Iterator[Text]:
+    if self.start >= self.end:
+      return
+    decoder = io.IncrementalNewlineDecoder(
+      codecs.getincrementaldecoder(self.encoding)(), translate=True)
+    with open(self.path, 'rb') as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+      for pos in range(self.start, self.end, _TEXT_CHUNK_SIZE):
+        text = decoder.decode(m[pos:min(pos + _TEXT_CHUNK_SIZE, self.end)])
+        if text:
+          yield html.escape(text, quote=False)
+    text = decoder.decode(b'', final=True)
+    if text:
+      yield html.escape(text, quote=False)
+
+
+class Hint(NamedTuple):
+  """A <link> resource hint for a reference's target, like a preload.
+
+  The hint is written with the page, and left out if the target is inlined
+  there, since an inlined target needs no fetch, or is the page itself. A
+  hint does not make its target part of the site by itself.
+  """
+  rel: Text
+  ref: linker.Reference
+  destination: Optional[Text] = None
 
-Fragment = Union[Text, MixedContent, HTMLNode, linker.Reference]
+  def render(self, link: linker.Linker, path: Optional[str] = None) -> Text:
+    """Render the hint in the page written to path."""
+    if (link.inlined(self.ref)
+        or link.resolve(self.ref, absolute=True) == path):
+      return ''
+    attrs = {'rel': self.rel, 'href': link.url(self.ref)}
+    if self.destination is not None:
+      attrs['as'] = self.destination
+    return ''.join(IterChunks(HTMLNode('link', attrs, MixedContent([]))))
+
+
+class Prerendered(NamedTuple):
+  """A fragment serialized ahead of time.
+
+  The fragment's HTML is kept as a sequence of text runs interleaved with the
+  references it contains, which are resolved when the page is written. Use
+  Prerender to build one from a fragment that is shared by many pages.
+  """
+  chunks: Tuple['Chunk', ...]
+  references: FrozenSet[Union[linker.Reference, linker.Embed]]
+
+  def __reduce__(self):
+    # Sets pickle in an order that varies from process to process, so pickle
+    # the chunks alone to keep pickled pages reproducible
+    return (_PrerenderedFromChunks, (self.chunks,))
+
+
+Fragment = Union[Text, MixedContent, HTMLNode, TextFile, Hint, Prerendered,
+                 linker.Reference, linker.Embed, linker.Stamp]
+
+# Serialized HTML: text, and the values filled in when a page is written
+Chunk = Union[Text, Hint, linker.Reference, linker.Embed, linker.Stamp]
+
+# Number of characters batched between the serializer and the output file.
+# Chunks are small (a tag or a text run), so this bounds the number of writes.
+_WRITE_BUFFER_SIZE = 1 << 16
+
+
+def IterChunks(item: Fragment) -> Iterator[Chunk]:
+  """Serialize a fragment as a stream of text chunks and references.
+
+  The tree is walked with an explicit stack rather than by recursion, so
+  serializing a deep tree neither hits the recursion limit nor builds an
+  intermediate string for each level. This covers only serialization:
+  parsing, rendering and pickling a page still recurse on its depth. Plain
+  strings pushed onto the stack are emitted verbatim, which is how the
+  punctuation between an element's attributes and content is sequenced.
+  """
+  stack: List[Fragment] = [item]
+  while stack:
+    item = stack.pop()
+    if isinstance(item, str):
+      yield item
+    elif isinstance(item, MixedContent):
+      # TODO: Indent HTML tags excluding pre?
+      stack.extend(reversed(item.parts))
+    elif isinstance(item, HTMLNode):
+      yield f'<{item.tag}'
+      stack.append(f'</{item.tag}>')
+      stack.append(item.content)
+      stack.append('>')
+      for key, value in reversed(item.attrs.items()):
+        stack.append('"')
+        stack.append(value)
+        stack.append(f' {key}="')
+    elif isinstance(item, TextFile):
+      yield from item.chunks()
+    elif isinstance(item, Prerendered):
+      yield from item.chunks
+    elif isinstance(item, (Hint, linker.Reference, linker.Embed,
+                           linker.Stamp)):
+      yield item
+    else:
+      raise TypeError(item)
+
+
+def _PrerenderedFromChunks(chunks: Tuple[Chunk, ...]) -> Prerendered:
+  return Prerendered(
+    chunks=chunks,
+    references=frozenset(c for c in chunks
+                         if isinstance(c, (linker.Reference, linker.Embed))))
+
+
+def Prerender(fragment: Fragment) -> Prerendered:
+  chunks: List[Chunk] = []
+  text: List[Text] = []
+  for chunk in IterChunks(fragment):
+    if isinstance(chunk, str):
+      text.append(chunk)
+    else:
+      if text:
+        chunks.append(''.join(text))
+        text = []
+      chunks.append(chunk)
+  if text:
+    chunks.append(''.join(text))
+  return _PrerenderedFromChunks(tuple(chunks))
 
 
 class PageResource(linker.Resource):
@@ -22,7 +185,7 @@ class PageResource(linker.Resource):
     super().__init__()
     self._fragment = fragment
 
-  def get_references(self) -> Set[linker.Reference]:
+  def get_references(self) -> Set[Union[linker.Reference, linker.Embed]]:
     refs = set()
     frontier = [self._fragment]
     while frontier:
@@ -35,33 +198,44 @@ class PageResource(linker.Resource):
         elif isinstance(item, HTMLNode):
           new_frontier.extend(item.attrs.values())
           new_frontier.append(item.content)
-        elif isinstance(item, linker.Reference):
+        elif isinstance(item, Prerendered):
+          refs |= item.references
+        elif isinstance(item, (linker.Reference, linker.Embed)):
           refs.add(item)
+        elif isinstance(item, (TextFile, Hint, linker.Stamp)):
+          pass
         else:
           raise TypeError(item)
       frontier = new_frontier
     return refs
 
+  def _iter_fragment(self, item: Fragment, link: linker.Linker,
+                     path: Optional[str] = None) -> Iterator[Text]:
+    for chunk in IterChunks(item):
+      if isinstance(chunk, str):
+        yield chunk
+      elif isinstance(chunk, linker.Stamp):
+        yield link.stamp(chunk)
+      elif isinstance(chunk, Hint):
+        yield chunk.render(link, path)
+      else:
+        yield link.url(chunk)
+
   def _render_fragment(self, item: Fragment,
                        link: linker.Linker) -> Text:
-    if isinstance(item, str):
-      return item
-    elif isinstance(item, MixedContent):
-      # TODO: Indent HTML tags excluding pre?
-      return ''.join(self._render_fragment(p, link) for p in item.parts)
-    elif isinstance(item, HTMLNode):
-      parts = [item.tag]
-      for key, value in item.attrs.items():
-        value = self._render_fragment(value, link)
-        parts.append(f'{key}="{value}"')
-      opentag = ' '.join(parts)
-      content = self._render_fragment(item.content, link)
-      return f'<{opentag}>{content}</{item.tag}>'
-    elif isinstance(item, linker.Reference):
-      return f'/{link.resolve(item)}'
-    else:
-      raise TypeError(item)
+    return ''.join(self._iter_fragment(item, link))
 
   def populate_fs(self, path: str, link: linker.Linker):
-    with open(path, 'wt') as f:
-      f.write(self._render_fragment(self._fragment, link))
+    written = 0
+    with link.output.open(path) as f:
+      batch: List[Text] = []
+      size = 0
+      for chunk in self._iter_fragment(self._fragment, link, path):
+        batch.append(chunk)
+        size += len(chunk)
+        if size >= _WRITE_BUFFER_SIZE:
+          written += f.write(''.join(batch).encode('utf-8'))
+          batch = []
+          size = 0
+      written += f.write(''.join(batch).encode('utf-8'))
+    tracing.Annotate(bytes_out=written)
@@ -0,0 +1,149 @@
+import contextlib
+import hashlib
+import json
+import mimetypes
+import os
+from typing import BinaryIO, Callable, Dict, Iterator, NamedTuple, Optional, TextIO, Tuple
+
+from web_compiler.backend import cache
+from web_compiler.backend import linker
+
+# Cache-Control header of each cache class. Immutable files have a content
+# hash in their name, so they never change; anything else is revalidated.
+CACHE_CONTROL = {
+  'immutable': 'public, max-age=31536000, immutable',
+  'revalidate': 'no-cache',
+}
+
+# Hex digits of a file's SHA-256 used as its ETag
+_ETAG_LENGTH = 32
+
+
+class ServedFile(NamedTuple):
+  """What a static server needs to know to serve one output file."""
+  size: int
+  etag: str
+  content_type: Optional[str]
+  content_encoding: Optional[str]
+  cache: str
+
+
+class _HashingWriter(object):
+
+  def __init__(self, f: BinaryIO):
+    super().__init__()
+    self._f = f
+    self.size = 0
+    self.sha256 = hashlib.sha256()
+
+  def write(self, data: bytes) -> int:
+    self.size += len(data)
+    self.sha256.update(data)
+    return self._f.write(data)
+
+
+class ServingOutput(linker.Output):
+  """Linker output that records the size and content hash of every file.
+
+  Files written through open are hashed as they are written, and copied files
+  are hashed with hasher. A symlink is served as its target. Paths are
+  recorded relative to root, which should be the linker's fs_root; see files.
+  """
+
+  def __init__(self, output: linker.Output, root: str = '', *,
+               hasher: Optional[cache.FileHasher] = None):
+    super().__init__()
+    self._output = output
+    self._root = root
+    self._hasher = hasher or cache.FileHasher()
+    self._files: Dict[str, Tuple[int, bytes]] = dict()
+    self._links: Dict[str, str] = dict()
+
+  @contextlib.contextmanager
+  def open(self, path: str) -> Iterator[BinaryIO]:
+    with self._output.open(path) as f:
+      writer = _HashingWriter(f)
+      yield writer
+    self._files[path] = (writer.size, writer.sha256.digest())
+
+  def copy_file(self, src: str, path: str):
+    self._output.copy_file(src, path)
+    digest = self._hasher.hash_files([src])[src]
+    self._files[path] = (os.path.getsize(src), digest)
+
+  def symlink(self, target: str, path: str):
+    self._output.symlink(target, path)
+    self._links[path] = os.path.normpath(
+      os.path.join(os.path.dirname(path), target))
+
+  def files(self, immutable: Callable[[str], bool]) -> Dict[str, ServedFile]:
+    """Describe each file written, by URL path.
+
+    immutable tells whether the file at an output path never changes. The
+    .gz sibling of a file is in the same cache class as the file.
+    """
+    files = dict()
+    for path in sorted(self._files.keys() | self._links.keys()):
+      real = path
+      while real in self._links:
+        real = self._links[real]
+      size, digest = self._files[real]
+      content_type, content_encoding = mimetypes.guess_type(path)
+      if content_type is not None and content_type.startswith('text/'):
+        content_type += '; charset=utf-8'
+      uncompressed = path[:-3] if content_encoding == 'gzip' else path
+      url = '/' + os.path.relpath(path, self._root or '.').replace(os.sep, '/')
+      files[url] = ServedFile(
+        size=size,
+        etag=f'"{digest.hex()[:_ETAG_LENGTH]}"',
+        content_type=content_type,
+        content_encoding=content_encoding,
+        cache='immutable' if immutable(uncompressed) else 'revalidate')
+    return files
+
+
+def WriteJSON(files: Dict[str, ServedFile], f: TextIO):
+  json.dump({url: served._asdict() for url, served in files.items()}, f,
+            indent=2, sort_keys=True)
+  f.write('\n')
+
+
+def _Identity(files: Dict[str, ServedFile]) -> Iterator[Tuple[str, ServedFile]]:
+  # Precompressed siblings are served in place of their file, for its URL
+  return ((url, served) for url, served in files.items()
+          if served.content_encoding is None)
+
+
+def _WeakETag(served: ServedFile) -> str:
+  # The header covers the identity and precompressed representations of a
+  # URL, which differ byte for byte, so only a weak validator holds for both
+  return 'W/' + served.etag
+
+
+def WriteNginxMap(files: Dict[str, ServedFile], f: TextIO):
+  f.write('# Include in the http block, and in the server block use:\n'
+          '#   etag off;\n'
+          '#   add_header Cache-Control $web_compiler_cache_control;\n'
+          '#   add_header ETag $web_compiler_etag;\n')
+  for name, value in [
+      ('cache_control', lambda s: CACHE_CONTROL[s.cache]),
+      ('etag', _WeakETag)]:
+    f.write(f'map $uri $web_compiler_{name} {{\n  default "";\n')
+    for url, served in _Identity(files):
+      f.write(f'  {json.dumps(url)} {json.dumps(value(served))};\n')
+    f.write('}\n')
+
+
+def WriteHeaders(files: Dict[str, ServedFile], f: TextIO):
+  """Write headers in the _headers format of Netlify and Cloudflare Pages."""
+  for url, served in _Identity(files):
+    f.write(f'{url}\n'
+            f'  Cache-Control: {CACHE_CONTROL[served.cache]}\n'
+            f'  ETag: {_WeakETag(served)}\n')
+
+
+WRITERS: Dict[str, Callable[[Dict[str, ServedFile], TextIO], None]] = {
+  'json': WriteJSON,
+  'nginx': WriteNginxMap,
+  'headers': WriteHeaders,
+}
@@ -7,12 +7,18 @@ from absl import flags
 
 from web_compiler.backend import linker
 from web_compiler.backend import page
+from web_compiler.backend.swiss import highlight
 from web_compiler.frontend import document
 from web_compiler.frontend import nav
 
-flags.DEFINE_string('info_file', None, 'TODO')
-flags.DEFINE_string('version_file', None, 'TODO')
-flags.mark_flags_as_required(['info_file', 'version_file'])
+flags.DEFINE_string(
+  'info_file', None,
+  'Bazel\'s stable status file, read for the build stamp. Required unless '
+  'the only pages rendered are hermetic.')
+flags.DEFINE_string(
+  'version_file', None,
+  'Bazel\'s volatile status file, read for the build stamp. Required unless '
+  'the only pages rendered are hermetic.')
 
 FLAGS = flags.FLAGS
 
@@ -38,14 +44,34 @@ def RenderText(text) -> page.Fragment:
   return page.MixedContent([html.escape(text, quote=False)])
 
 
+@Render.register(document.TextFile)
+def RenderTextFile(text) -> page.Fragment:
+  return page.TextFile(path=text.path, start=text.start, end=text.end,
+                       encoding=text.encoding)
+
+
 @Render.register(document.MixedContent)
 def RenderMixedContent(mc) -> page.Fragment:
   return page.MixedContent([Render(p) for p in mc.parts])
 
 
-def H(tag: Text, attrs: Optional[Dict[Text, Text]] = None,
+def _Embed(tag: Text, attrs: Dict[Text, Any]) -> Dict[Text, Any]:
+  """Mark a reference to an image or stylesheet as one that can be inlined."""
+  if tag == 'img':
+    key = 'src'
+  elif tag == 'link' and attrs.get('rel') == 'stylesheet':
+    key = 'href'
+  else:
+    return attrs
+  value = attrs.get(key)
+  if not isinstance(value, linker.Reference):
+    return attrs
+  return {**attrs, key: linker.Embed(value)}
+
+
+def H(tag: Text, attrs: Optional[Dict[Text, Any]] = None,
       content: Optional[page.MixedContent] = None) -> page.HTMLNode:
-  return page.HTMLNode(tag=tag, attrs=attrs or {},
+  return page.HTMLNode(tag=tag, attrs=_Embed(tag, attrs or {}),
                        content=content or page.MixedContent([]))
 
 
@@ -84,7 +110,16 @@ def _ParseBazelInfo(filename: str) -> Dict[str, str]:
   return result
 
 
-def FooterBlock(copyright: page.Fragment) -> page.Fragment:
+class BuildStamp(NamedTuple):
+  year: int
+  date: Text
+  git_ref: Text
+  git_url: Text
+
+
+def GetBuildStamp() -> BuildStamp:
+  if FLAGS.info_file is None or FLAGS.version_file is None:
+    raise ValueError('The build stamp needs --info_file and --version_file')
   # Get the build timestamp to embed in the footer
   version = _ParseBazelInfo(FLAGS.version_file)
   ts = datetime.datetime.utcfromtimestamp(int(version['BUILD_TIMESTAMP']))
@@ -98,37 +133,127 @@ def FooterBlock(copyright: page.Fragment) -> page.Fragment:
     git_hash = git_ref
   # TODO: Use the same mechanism to get the git remote URL
   git_url = info['STABLE_GIT_URL'].format(git_hash=git_hash)
+  return BuildStamp(year=datetime.datetime.now().year, date=date,
+                    git_ref=git_ref, git_url=git_url)
+
+
+# Version of this backend's output. Bump it whenever a change here alters the
+# page rendered for an unchanged document, so that cached pages are rebuilt.
+RENDER_VERSION = 4
+
+
+def BuildStamps() -> Dict[Text, Text]:
+  """The values of the linker.Stamps in a hermetic Chrome, by key."""
+  return {key: str(value) for key, value in GetBuildStamp()._asdict().items()}
+
+
+def RenderStamp(*, hermetic: bool = False,
+                resource_hints: bool = False) -> Text:
+  """Describe everything besides the document itself that affects Render.
+
+  The options are those the Chrome is built with. Pages rendered with a
+  hermetic Chrome do not depend on the build stamp.
+  """
+  stamp = 'hermetic' if hermetic else GetBuildStamp()
+  return repr((RENDER_VERSION, stamp, resource_hints))
+
+
+def FooterBlock(copyright: page.Fragment, chrome: 'Chrome') -> page.Fragment:
   return page.MixedContent([
     H('div', {'class': 'footer-left'}, page.MixedContent([
-      f'Copyright © {datetime.datetime.now().year} ',
+      chrome.copyright_prefix,
       copyright,
     ])),
-    H('div', {'class': 'footer-right'}, page.MixedContent([
-      f'Built {date} from ',
-      H('a', {'class': 'footer-git', 'href': git_url}, git_ref),
-    ])),
+    chrome.footer_right,
   ])
 
 
+STYLE = linker.Reference('web_compiler/backend/swiss/style.css')
+
+
+class Chrome(NamedTuple):
+  """Parts of every page that do not depend on the page's document.
+
+  Build one with BuildChrome once per site and pass it to RenderDocument, so
+  that the nav, head and footer are rendered and serialized only once.
+
+  A hermetic Chrome holds linker.Stamps in place of the build stamp, and the
+  Linker fills in the values from BuildStamps when pages are written. Pages
+  rendered with it depend only on their documents, so they are the same from
+  one build to the next and can be cached.
+
+  head_hints holds the resource hints of every page; see ResourceHints.
+  """
+  head_meta: page.Prerendered
+  head_links: page.Prerendered
+  nav: Optional[page.Prerendered]
+  copyright_prefix: page.Prerendered
+  footer_right: page.Prerendered
+  head_hints: Optional[page.Prerendered] = None
+
+
+def ResourceHints(nav: page.Prerendered) -> page.Prerendered:
+  """Hint what the links of the nav will need, from the nav's references.
+
+  Every page shows the nav, so its icons are preloaded, unless they are
+  inlined, and the pages it links to are prefetched for the next navigation.
+  The stylesheet is already linked from the head, so it is not hinted.
+  """
+  icons = {r.ref for r in nav.references if isinstance(r, linker.Embed)}
+  targets = {r for r in nav.references if isinstance(r, linker.Reference)}
+  return page.Prerender(page.MixedContent(
+    [page.Hint('preload', ref, 'image') for ref in sorted(icons)] +
+    [page.Hint('prefetch', ref) for ref in sorted(targets)]))
+
+
+def BuildChrome(nav_items: Sequence[nav.NavItem] = (), *,
+                hermetic: bool = False,
+                resource_hints: bool = False) -> Chrome:
+  if hermetic:
+    stamp = BuildStamp(*(linker.Stamp(key) for key in BuildStamp._fields))
+  else:
+    stamp = BuildStamp(**BuildStamps())
+  nav = page.Prerender(Nav(nav_items)) if nav_items else None
+  return Chrome(
+    head_meta=page.Prerender(H('meta', {'charset': 'utf-8'})),
+    head_links=page.Prerender(
+      H('link', {'rel': 'stylesheet', 'href': STYLE, 'type': 'text/css'})),
+    nav=nav,
+    copyright_prefix=page.Prerender(
+      page.MixedContent(['Copyright © ', stamp.year, ' '])),
+    footer_right=page.Prerender(
+      H('div', {'class': 'footer-right'}, page.MixedContent([
+        'Built ', stamp.date, ' from ',
+        H('a', {'class': 'footer-git', 'href': stamp.git_url}, stamp.git_ref),
+      ]))),
+    head_hints=ResourceHints(nav) if resource_hints and nav else None,
+  )
+
+
 @Render.register(document.Document)
-def RenderDocument(doc, *, nav_items: Sequence[nav.NavItem] = ()) -> page.Fragment:
+def RenderDocument(doc, *, nav_items: Sequence[nav.NavItem] = (),
+                   chrome: Optional[Chrome] = None) -> page.Fragment:
+  if chrome is None:
+    chrome = BuildChrome(nav_items)
   title = Render(doc.title)
   subtitle = Render(doc.subtitle)
   copyright = Render(doc.copyright)
   sections = page.MixedContent([Render(s) for s in doc.sections])
-  style = linker.Reference('web_compiler/backend/swiss/style.css')
 
-  head = H('head', {}, page.MixedContent([
-    H('meta', {'charset': 'utf-8'}),
+  head_parts = [
+    chrome.head_meta,
     H('title', {}, title),
-    H('link', {'rel': 'stylesheet', 'href': style, 'type': 'text/css'}),
-  ]))
-  if nav_items:
+    chrome.head_links,
+  ]
+  if chrome.head_hints is not None:
+    head_parts.append(chrome.head_hints)
+  head = H('head', {}, page.MixedContent(head_parts))
+  if chrome.nav is not None:
     header = H('header', {},
       H('div', {'class': 'hcenter header-flexbox'}, page.MixedContent([
         TitleBlock(title, subtitle),
         H('div', {'class': 'header-vr title-rule'}),
-        Nav(nav_items),
+        chrome.nav,
       ])))
   else:
     header = H('header', {},
@@ -138,7 +263,7 @@ def RenderDocument(doc, *, nav_items: Sequence[nav.NavItem] = ()) -> page.Fragme
       H('div', {'class': 'body-copy'}, sections)))
   footer = H('footer', {},
     H('div', {'class': 'hcenter footer-flexbox'},
-      FooterBlock(copyright)))
+      FooterBlock(copyright, chrome)))
 
   return page.MixedContent([
     '<!DOCTYPE html>',
@@ -169,9 +294,24 @@ def RenderHTMLNode(node) -> page.Fragment:
   return page.HTMLNode(tag=node.tag, attrs=node.attrs, content=content)
 
 
+def RenderCodeContent(content, lang) -> page.Fragment:
+  """Render code, highlighting it at build time if its language is given.
+
+  Code in a language there is no highlighter for is rendered plain.
+  """
+  if lang not in highlight.LEXERS:
+    return Render(content)
+  # The lexer needs the whole text, so listings left in their files are read
+  parts = [p.read() if isinstance(p, document.TextFile) else p
+           for p in content.parts]
+  if not all(isinstance(p, str) for p in parts):
+    raise ValueError(f'Code highlighted as {lang!r} must be plain text')
+  return highlight.Highlight(lang, ''.join(parts))
+
+
 @Render.register(document.Code)
 def RenderCode(code) -> page.Fragment:
-  content = Render(code.content)
+  content = RenderCodeContent(code.content, code.lang)
   return H('span', {'class': 'code'}, content)
 
 
@@ -179,14 +319,14 @@ def RenderCode(code) -> page.Fragment:
 def RenderCodeBlock(block) -> page.Fragment:
   if block.header is not None:
     header = Render(block.header)
-    body = Render(block.body)
+    body = RenderCodeContent(block.body, block.lang)
     return H('div', {'class': 'code'}, page.MixedContent([
       H('div', {'class': 'code-header'}, header),
       H('div', {'class': 'code-body'},
         H('pre', {}, body)),
     ]))
   else:
-    body = Render(block.body)
+    body = RenderCodeContent(block.body, block.lang)
     return H('div', {'class': 'code'},
       H('div', {'class': 'code-body'},
         H('pre', {}, body)))
@@ -0,0 +1,144 @@
+import collections
+import hashlib
+import html
+import re
+import threading
+from typing import Dict, Iterable, Mapping, Optional, Text, Tuple
+
+from web_compiler.backend import page
+
+
+class Lexer(object):
+  """Marks up classified tokens in text with one regular expression.
+
+  The pattern is an alternation of named groups, one per token class, and is
+  matched against the text after HTML escaping: '<', '>' and '&' appear in it
+  as '&lt;', '&gt;' and '&amp;'. Text matched by no group is left as is. The
+  groups must not nest, so that each match's class is its lastgroup. Tokens
+  of the group named 'word' are classified by looking them up in words, and
+  left unclassified if they are not found there; this is much faster than
+  spelling out each keyword in the pattern.
+  """
+
+  def __init__(self, pattern: str, flags: int = 0, *,
+               words: Optional[Mapping[Text, Text]] = None):
+    super().__init__()
+    self._regex = re.compile(pattern, flags | re.VERBOSE)
+    self._words = words or {}
+    classes = set(self._regex.groupindex) | set(self._words.values())
+    self._open = {cls: f'<span class="hl-{cls}">' for cls in classes}
+
+  def highlight(self, text: Text) -> Text:
+    """Escape text as HTML, wrapping each token of class c in span.hl-c."""
+    text = html.escape(text, quote=False)
+    words = self._words
+    parts = []
+    append = parts.append
+    pos = 0
+    for m in self._regex.finditer(text):
+      cls = m.lastgroup
+      token = m.group()
+      if cls == 'word':
+        cls = words.get(token)
+        if cls is None:
+          continue
+      start, end = m.span()
+      append(text[pos:start])
+      append(self._open[cls])
+      append(token)
+      append('</span>')
+      pos = end
+    append(text[pos:])
+    return ''.join(parts)
+
+
+def _Words(cls: Text, words: Iterable[Text]) -> Dict[Text, Text]:
+  return {w: cls for w in words}
+
+
+C = Lexer(r"""
+    (?P<comment> /\*.*?\*/ | //[^\n]* )
+  | (?P<preprocessor> ^[ \t]*\#[^\n]* )
+  | (?P<string> "(?:[^"\\\n]|\\.)*" | '(?:[^'\\\n]|\\.)*' )
+  | (?P<word> [A-Za-z_]\w* )
+  | (?P<number> [0-9](?:[xX][0-9a-fA-F]+|[0-9]*(?:\.[0-9]*)?(?:[eE][+-]?[0-9]+)?)
+        [uUlLfF]* )
+""", re.MULTILINE | re.DOTALL, words={
+  **_Words('keyword', [
+    'auto', 'break', 'case', 'const', 'continue', 'default', 'do', 'else',
+    'enum', 'extern', 'for', 'goto', 'if', 'inline', 'register', 'restrict',
+    'return', 'sizeof', 'static', 'struct', 'switch', 'typedef', 'union',
+    'volatile', 'while',
+  ]),
+  **_Words('type', [
+    '_Bool', 'bool', 'char', 'double', 'float', 'int', 'long', 'short',
+    'signed', 'unsigned', 'void', 'size_t', 'ssize_t', 'int8_t', 'int16_t',
+    'int32_t', 'int64_t', 'uint8_t', 'uint16_t', 'uint32_t', 'uint64_t',
+  ]),
+})
+
+# Disassembly as printed by objdump -d
+OBJDUMP = Lexer(r"""
+    (?P<label> ^[0-9a-f]+[ \t]+&lt;[^\n]*?&gt;: )
+  | (?P<address> ^[ \t]*[0-9a-f]+: )
+  | (?P<bytes> (?<=:)[ \t]+(?:[0-9a-f]{2}[ ])+ )
+  | (?P<comment> \#[^\n]* )
+  | (?P<symbol> &lt;[^\n]*?&gt; )
+  | (?P<register> %[a-z][a-z0-9]* )
+  | (?P<immediate> \$-?(?:0x[0-9a-f]+|[0-9]+) )
+  | (?P<number> -?\b(?:0x[0-9a-f]+|[0-9a-f]+(?=[ \t]+&lt;)|[0-9]+)\b )
+  | (?P<mnemonic> (?<=[ \t])[a-z][a-z0-9.]*\b )
+""", re.MULTILINE)
+
+LEXERS: Dict[Text, Lexer] = {
+  'c': C,
+  'objdump': OBJDUMP,
+}
+
+
+# Total size of the highlighted HTML that Highlight keeps for reuse
+_CACHE_MAX_BYTES = 8 << 20
+
+_cache: 'collections.OrderedDict[Tuple[Text, bytes], page.Prerendered]' = (
+  collections.OrderedDict())
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+
+
+def ClearCache():
+  global _cache_bytes
+  with _cache_lock:
+    _cache.clear()
+    _cache_bytes = 0
+
+
+def Highlight(lang: Text, text: Text) -> page.Prerendered:
+  """Render code in lang as highlighted HTML.
+
+  Results are memoized on the language and a SHA-256 of the text, so a
+  listing included by many pages is tokenized and serialized once per
+  process. Only the results are kept, up to _CACHE_MAX_BYTES of them, and
+  the least recently used go first.
+  """
+  global _cache_bytes
+  try:
+    lexer = LEXERS[lang]
+  except KeyError:
+    raise ValueError(f'No highlighter for language {lang!r}') from None
+  key = (lang, hashlib.sha256(text.encode('utf-8', 'surrogatepass')).digest())
+  with _cache_lock:
+    result = _cache.get(key)
+    if result is not None:
+      _cache.move_to_end(key)
+      return result
+  highlighted = lexer.highlight(text)
+  result = page.Prerendered(chunks=(highlighted,), references=frozenset())
+  if len(highlighted) <= _CACHE_MAX_BYTES:
+    with _cache_lock:
+      if key not in _cache:
+        _cache[key] = result
+        _cache_bytes += len(highlighted)
+      while _cache_bytes > _CACHE_MAX_BYTES:
+        _, evicted = _cache.popitem(last=False)
+        _cache_bytes -= len(evicted.chunks[0])
+  return result
@@ -0,0 +1,326 @@
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
+
+from absl import app
+from absl import flags
+
+from web_compiler.backend import archive
+from web_compiler.backend import linker
+from web_compiler.backend import page
+from web_compiler.backend.swiss import document as swissdoc
+from web_compiler.backend.swiss import highlight
+from web_compiler.bench import corpus
+from web_compiler.bench import legacy_ir
+from web_compiler.frontend import frontend
+
+flags.DEFINE_integer('documents', 100, 'Number of documents in the corpus.')
+flags.DEFINE_integer('sections', 5, 'Number of sections per document.')
+flags.DEFINE_integer('depth', 3, 'Nesting depth of HTML in each section.')
+flags.DEFINE_integer('code_lines', 40, 'Lines in each code block.')
+flags.DEFINE_integer('include_fanout', 2, 'XIncludes per document.')
+flags.DEFINE_integer('assets', 4, 'Number of nav icon assets.')
+flags.DEFINE_integer('repeats', 3, 'Timed runs per phase; the fastest is kept.')
+flags.DEFINE_bool('memory', True, 'Also measure peak traced memory per phase.')
+flags.DEFINE_bool('ir_memory', True,
+                  'Compare the memory held by the parsed documents and page '
+                  'fragments against the legacy NamedTuple IR.')
+flags.DEFINE_float('highlight_mb', 4,
+                   'Size in MB of the listings used to measure syntax '
+                   'highlighting throughput; 0 to skip it.')
+flags.DEFINE_string('work_dir', None,
+                    'Directory for the corpus and outputs. Defaults to a '
+                    'temporary directory.')
+flags.DEFINE_string('output', None, 'Write the results to this JSON file.')
+flags.DEFINE_string('baseline', None,
+                    'Compare against results previously written by --output.')
+flags.DEFINE_float('tolerance', 0.10,
+                   'Relative slowdown or memory growth over the baseline that '
+                   'is reported as a regression.')
+
+FLAGS = flags.FLAGS
+
+# The benchmark writes its own build stamps; see _WriteStamps.
+FLAGS.set_default('info_file', '')
+FLAGS.set_default('version_file', '')
+
+STYLE = os.path.join(os.path.dirname(swissdoc.__file__), 'style.css')
+
+
+class PhaseResult(NamedTuple):
+  seconds: float
+  peak_bytes: int
+
+
+class HighlightResult(NamedTuple):
+  bytes: int
+  seconds: float
+  cached_seconds: float
+
+
+class NullOutput(linker.Output):
+  """Linker output that discards everything, counting the bytes written."""
+
+  def __init__(self):
+    super().__init__()
+    self.bytes = 0
+
+  class _Sink(object):
+
+    def __init__(self, output: 'NullOutput'):
+      self._output = output
+
+    def __enter__(self):
+      return self
+
+    def __exit__(self, *args):
+      pass
+
+    def write(self, data: bytes) -> int:
+      self._output.bytes += len(data)
+      return len(data)
+
+  def open(self, path: str) -> '_Sink':
+    return self._Sink(self)
+
+  def copy_file(self, src: str, path: str):
+    self.bytes += os.stat(src).st_size
+
+  def symlink(self, target: str, path: str):
+    pass
+
+
+def _WriteStamps(root: str):
+  FLAGS.info_file = os.path.join(root, 'stable-status.txt')
+  FLAGS.version_file = os.path.join(root, 'volatile-status.txt')
+  with open(FLAGS.info_file, 'wt') as f:
+    f.write('STABLE_GIT_URL https://example.com/{git_hash}\n')
+    f.write('STABLE_GIT_COMMIT 0123456789abcdef\n')
+  with open(FLAGS.version_file, 'wt') as f:
+    f.write('BUILD_TIMESTAMP 0\n')
+
+
+def _Measure(run: Callable[[], Any]) -> PhaseResult:
+  seconds = float('inf')
+  for _ in range(FLAGS.repeats):
+    gc.collect()
+    start = time.perf_counter()
+    run()
+    seconds = min(seconds, time.perf_counter() - start)
+  peak = 0
+  if FLAGS.memory:
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+  return PhaseResult(seconds=seconds, peak_bytes=peak)
+
+
+def _MakeLinker(
+    c: corpus.Corpus, fragments: List[page.Fragment], root: str,
+    output: linker.Output,
+) -> Tuple[linker.Linker, Dict[linker.Reference, page.PageResource]]:
+  link = linker.Linker(root, output=output)
+  pages = dict()
+  link.add_resource(ref=swissdoc.STYLE, out='site/assets/style.css',
+                    resource=linker.StaticResource(STYLE))
+  for asset in c.assets:
+    link.add_resource(
+      ref=linker.Reference(asset.src_url),
+      out=os.path.join('site', 'assets', os.path.basename(asset.path)),
+      resource=linker.StaticResource(asset.path))
+  for doc, fragment in zip(c.documents, fragments):
+    base, _ = os.path.splitext(os.path.basename(doc.path))
+    ref = linker.Reference(doc.src_url)
+    pages[ref] = page.PageResource(fragment)
+    link.add_resource(ref=ref, out=os.path.join('site', base + '.html'),
+                      resource=pages[ref])
+  return link, pages
+
+
+def RunBenchmarks(c: corpus.Corpus, root: str) -> Dict[str, PhaseResult]:
+  """Time and memory-profile each phase of a build of the corpus.
+
+  Each phase is measured on its own, taking the outputs of the phases before
+  it as already computed, so a regression is attributed to one phase.
+  """
+  load = frontend.Loader(c.path_map)
+  nav_items = load.LoadNav(c.nav)
+  chrome = swissdoc.BuildChrome(nav_items)
+  results = dict()
+
+  def Load():
+    # A fresh loader each run, so the include cache starts cold
+    loader = frontend.Loader(c.path_map)
+    return [loader.LoadDocument(d.path) for d in c.documents]
+  results['load'] = _Measure(Load)
+  docs = Load()
+
+  def Render():
+    return [swissdoc.RenderDocument(d, nav_items=nav_items, chrome=chrome)
+            for d in docs]
+  results['render'] = _Measure(Render)
+  fragments = Render()
+  refs = {linker.Reference(d.src_url) for d in c.documents}
+
+  def Serialize():
+    link, pages = _MakeLinker(c, fragments, '', NullOutput())
+    for ref, resource in pages.items():
+      resource.populate_fs(link.resolve(ref), link)
+  results['serialize'] = _Measure(Serialize)
+
+  def Link():
+    with tempfile.TemporaryDirectory(dir=root) as d:
+      link, _ = _MakeLinker(c, fragments, d, linker.DirectoryOutput())
+      link.link(refs)
+  results['link'] = _Measure(Link)
+
+  def Package():
+    with open(os.path.join(root, 'site.tar.gz'), 'wb') as f:
+      with archive.TarOutput(f) as output:
+        link, _ = _MakeLinker(c, fragments, '', output)
+        link.link(refs)
+  results['package'] = _Measure(Package)
+  return results
+
+
+def _Retained(build: Callable[[], Any]) -> int:
+  """Measure the memory still allocated by build's result once it returns."""
+  gc.collect()
+  tracemalloc.start()
+  result = build()
+  gc.collect()
+  current, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del result
+  return current
+
+
+def MeasureIRMemory(c: corpus.Corpus) -> Dict[str, int]:
+  """Compare the memory held by the compact and legacy IRs for a corpus.
+
+  Both are measured as copies of the same loaded documents and rendered
+  fragments that share their strings, so the figures cover the node
+  structures alone; this is what a site holds in memory until it is linked.
+  """
+  load = frontend.Loader(c.path_map)
+  nav_items = load.LoadNav(c.nav)
+  chrome = swissdoc.BuildChrome(nav_items)
+  docs = [load.LoadDocument(d.path) for d in c.documents]
+  fragments = [swissdoc.RenderDocument(d, nav_items=nav_items, chrome=chrome)
+               for d in docs]
+  trees = docs + fragments
+  return {
+    'compact_bytes': _Retained(lambda: [legacy_ir.Rebuild(t) for t in trees]),
+    'legacy_bytes': _Retained(lambda: [legacy_ir.ToLegacy(t) for t in trees]),
+  }
+
+
+def MeasureHighlight(size: int) -> Dict[str, HighlightResult]:
+  """Measure highlighting throughput on a generated listing per language.
+
+  seconds is the time to tokenize and serialize the listing from scratch.
+  cached_seconds is the time to find the memoized result for an equal listing
+  in another string object, as when pages include the same file.
+  """
+  results = dict()
+  for lang in sorted(highlight.LEXERS):
+    text = corpus.Listing(lang, size)
+    copy = ''.join(list(text))
+    seconds = cached_seconds = float('inf')
+    for _ in range(FLAGS.repeats):
+      highlight.ClearCache()
+      start = time.perf_counter()
+      highlight.Highlight(lang, text)
+      seconds = min(seconds, time.perf_counter() - start)
+      start = time.perf_counter()
+      highlight.Highlight(lang, copy)
+      cached_seconds = min(cached_seconds, time.perf_counter() - start)
+    results[lang] = HighlightResult(
+      bytes=len(text.encode('utf-8')), seconds=seconds,
+      cached_seconds=cached_seconds)
+  highlight.ClearCache()
+  return results
+
+
+def _Compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+  regressions = []
+  metrics = []
+  for phase, result in results['phases'].items():
+    base = baseline['phases'].get(phase)
+    if base is None:
+      continue
+    for metric in PhaseResult._fields:
+      metrics.append((f'{phase}.{metric}', base[metric], result[metric]))
+  for lang, result in results.get('highlight', {}).items():
+    base = baseline.get('highlight', {}).get(lang)
+    if base is not None:
+      metrics.append(
+        (f'highlight.{lang}.seconds', base['seconds'], result['seconds']))
+  if 'ir_memory' in results and 'ir_memory' in baseline:
+    old = baseline['ir_memory']['compact_bytes']
+    new = results['ir_memory']['compact_bytes']
+    metrics.append(('ir_memory.compact_bytes', old, new))
+  for name, old, new in metrics:
+    if old and new > old * (1 + FLAGS.tolerance):
+      regressions.append(
+        f'{name}: {old:.6g} -> {new:.6g} (+{100 * (new / old - 1):.1f}%)')
+  return regressions
+
+
+def main(argv):
+  if len(argv) > 1:
+    raise app.UsageError('Too many command-line arguments.')
+  config = corpus.CorpusConfig(
+    documents=FLAGS.documents, sections=FLAGS.sections, depth=FLAGS.depth,
+    code_lines=FLAGS.code_lines, include_fanout=FLAGS.include_fanout,
+    assets=FLAGS.assets)
+  with tempfile.TemporaryDirectory() as tmp:
+    root = FLAGS.work_dir or tmp
+    _WriteStamps(root)
+    c = corpus.Generate(os.path.join(root, 'corpus'), config)
+    phases = RunBenchmarks(c, root)
+    ir_memory = MeasureIRMemory(c) if FLAGS.ir_memory else None
+  highlight_results = None
+  if FLAGS.highlight_mb:
+    highlight_results = MeasureHighlight(int(FLAGS.highlight_mb * 1e6))
+  results = {
+    'config': config._asdict(),
+    'phases': {name: r._asdict() for name, r in phases.items()},
+  }
+  for name, r in phases.items():
+    print(f'{name:10} {r.seconds * 1e3:10.1f} ms {r.peak_bytes / 1e6:10.1f} MB')
+  if ir_memory is not None:
+    results['ir_memory'] = ir_memory
+    compact, legacy = ir_memory['compact_bytes'], ir_memory['legacy_bytes']
+    print(f'IR memory: compact {compact / 1e6:.1f} MB, legacy '
+          f'{legacy / 1e6:.1f} MB ({100 * compact / legacy:.0f}%)')
+  if highlight_results is not None:
+    results['highlight'] = {
+      lang: r._asdict() for lang, r in highlight_results.items()}
+    for lang, r in highlight_results.items():
+      print(f'highlight {lang:8} {r.bytes / r.seconds / 1e6:10.1f} MB/s, '
+            f'cached {r.cached_seconds * 1e3:.1f} ms')
+  if FLAGS.output:
+    with open(FLAGS.output, 'wt') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+  if FLAGS.baseline:
+    with open(FLAGS.baseline, 'rt') as f:
+      baseline = json.load(f)
+    if baseline['config'] != results['config']:
+      print('warning: baseline was measured with a different corpus config')
+    regressions = _Compare(results, baseline)
+    for r in regressions:
+      print(f'REGRESSION {r}')
+    if regressions:
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  app.run(main)
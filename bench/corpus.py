@@ -0,0 +1,161 @@
+import os
+import random
+from typing import Dict, List, NamedTuple
+from xml.sax import saxutils
+
+_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<document xmlns="http://sj-olsen.com/blog"
+          xmlns:html="http://www.w3.org/1999/xhtml"
+          xmlns:xi="http://www.w3.org/2001/XInclude">
+"""
+
+_WORDS = """lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod
+tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam quis
+nostrud exercitation ullamco laboris nisi aliquip ex ea commodo consequat""".split()
+
+
+class CorpusConfig(NamedTuple):
+  documents: int = 100
+  sections: int = 5
+  depth: int = 3
+  code_lines: int = 40
+  include_fanout: int = 2
+  assets: int = 4
+  seed: int = 0
+
+
+class Input(NamedTuple):
+  src_url: str
+  path: str
+
+
+class Corpus(NamedTuple):
+  documents: List[Input]
+  assets: List[Input]
+  nav: str
+  path_map: Dict[str, str]
+
+
+def _Sentence(rng: random.Random, words: int) -> str:
+  return ' '.join(rng.choice(_WORDS) for _ in range(words))
+
+
+def _Code(rng: random.Random, lines: int) -> str:
+  result = []
+  for i in range(lines):
+    name = rng.choice(_WORDS)
+    result.append(f'  int {name}_{i} = {name}({i}, "{rng.choice(_WORDS)}");')
+  return '\n'.join(['int main(void) {'] + result + ['}'])
+
+
+_MNEMONICS = ['mov', 'lea', 'push', 'pop', 'add', 'sub', 'xor', 'callq', 'jne']
+_REGISTERS = ['%rax', '%rbx', '%rbp', '%rdi', '%rsi', '%r12d', '%r13']
+
+
+def _Disassembly(rng: random.Random, lines: int) -> str:
+  result = ['0000000000001060 <main>:']
+  addr = 0x1060
+  for _ in range(lines):
+    size = rng.randrange(1, 8)
+    code = ' '.join(f'{rng.randrange(256):02x}' for _ in range(size))
+    operands = (f'${rng.randrange(256):#x},{rng.choice(_REGISTERS)}'
+                if rng.random() < 0.5 else
+                f'{rng.randrange(4096):#x}({rng.choice(_REGISTERS)})')
+    result.append(f'{addr:8x}:\t{code:21}\t{rng.choice(_MNEMONICS):6} '
+                  f'{operands}  # {addr + size:x} <main+{size:#x}>')
+    addr += size
+  return '\n'.join(result)
+
+
+def Listing(lang: str, size: int, seed: int = 0) -> str:
+  """Generate a listing of at least size characters in a highlighted language.
+
+  lang is 'c' for C source or 'objdump' for disassembly.
+  """
+  rng = random.Random(seed)
+  generate = {'c': _Code, 'objdump': _Disassembly}[lang]
+  parts = []
+  total = 0
+  while total < size:
+    parts.append(generate(rng, 1000))
+    total += len(parts[-1]) + 1
+  return '\n'.join(parts)
+
+
+def _Nested(rng: random.Random, depth: int) -> str:
+  text = saxutils.escape(_Sentence(rng, 40))
+  inner = f'<html:p>{text} <code>{rng.choice(_WORDS)}</code></html:p>'
+  for _ in range(depth):
+    inner = f'<html:div class="level">{inner}</html:div>'
+  return inner
+
+
+def _Document(rng: random.Random, config: CorpusConfig, index: int,
+              snippets: List[str]) -> str:
+  parts = [_HEADER]
+  parts.append(f'  <title>Document {index}</title>\n')
+  parts.append(f'  <subtitle>{_Sentence(rng, 5)}</subtitle>\n')
+  parts.append('  <copyright>Benchmark</copyright>\n')
+  for s in range(config.sections):
+    parts.append(f'  <section>\n    <title>Section {s}</title>\n    <body>\n')
+    parts.append('      ' + _Nested(rng, config.depth) + '\n')
+    code = saxutils.escape(_Code(rng, config.code_lines))
+    parts.append(f'      <code-block><body>{code}</body></code-block>\n')
+    if s == 0:
+      for j in range(config.include_fanout):
+        href = snippets[(index + j) % len(snippets)]
+        parts.append(
+          '      <code-block><header>Shared</header><body>'
+          f'<xi:include href="{href}" parse="text" /></body></code-block>\n')
+    parts.append('    </body>\n  </section>\n')
+  parts.append('</document>\n')
+  return ''.join(parts)
+
+
+_ICON = """<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 8 8">
+<rect width="8" height="8" fill="#{color:06x}"/>
+</svg>
+"""
+
+
+def Generate(root: str, config: CorpusConfig) -> Corpus:
+  """Write a synthetic site under root and describe its inputs.
+
+  Documents are linked from a nav with one item per asset, each asset being
+  the item's icon. Every document includes include_fanout snippets from a
+  shared pool of twice that many, so include caching has something to hit.
+  """
+  rng = random.Random(config.seed)
+  os.makedirs(root, exist_ok=True)
+  path_map: Dict[str, str] = dict()
+
+  def Write(name: str, content: str) -> Input:
+    path = os.path.join(root, name)
+    with open(path, 'wt', encoding='utf-8') as f:
+      f.write(content)
+    src_url = 'corpus/' + name
+    path_map[src_url] = path
+    return Input(src_url, path)
+
+  snippets = [
+    Write(f'snippet{i}.c', _Code(rng, config.code_lines)).src_url
+    for i in range(max(1, 2 * config.include_fanout))
+  ]
+  documents = [
+    Write(f'doc{i}.xml', _Document(rng, config, i, snippets))
+    for i in range(config.documents)
+  ]
+  assets = [
+    Write(f'icon{i}.svg', _ICON.format(color=rng.randrange(1 << 24)))
+    for i in range(config.assets)
+  ]
+  items = []
+  for i, asset in enumerate(assets):
+    target = documents[i % len(documents)].src_url if documents else ''
+    items.append(f'  <nav-item href="{target}" icon="{asset.src_url}">'
+                 f'Item {i}</nav-item>\n')
+  nav = Write('nav.xml', ''.join(
+    ['<?xml version="1.0" encoding="UTF-8"?>\n',
+     '<nav xmlns="http://sj-olsen.com/blog">\n'] + items + ['</nav>\n']))
+  return Corpus(documents=documents, assets=assets, nav=nav.path,
+                path_map=path_map)
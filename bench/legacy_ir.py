@@ -0,0 +1,97 @@
+from typing import Any, Dict, List, NamedTuple, Optional, Text
+
+from web_compiler.backend import page
+from web_compiler.frontend import document
+
+# The NamedTuple IR that frontend/document.py and backend/page.py used before
+# their compact representation, kept to measure the memory it saves.
+
+
+class MixedContent(NamedTuple):
+  parts: List[Any]
+
+
+class HTMLNode(NamedTuple):
+  tag: Text
+  attrs: Dict[Text, Any]
+  content: MixedContent
+
+
+class Document(NamedTuple):
+  title: MixedContent
+  subtitle: MixedContent
+  copyright: MixedContent
+  sections: List['Section']
+
+
+class Section(NamedTuple):
+  title: MixedContent
+  body: MixedContent
+
+
+class Code(NamedTuple):
+  content: MixedContent
+
+
+class CodeBlock(NamedTuple):
+  header: Optional[MixedContent]
+  body: MixedContent
+
+
+def ToLegacy(node: Any) -> Any:
+  """Copy a frontend document or page fragment into the legacy IR.
+
+  Strings and references are shared with the original; every container is
+  rebuilt, with a fresh attribute dict per element as the old code had.
+  """
+  if isinstance(node, (document.MixedContent, page.MixedContent)):
+    return MixedContent([ToLegacy(p) for p in node.parts])
+  elif isinstance(node, (document.HTMLNode, page.HTMLNode)):
+    return HTMLNode(tag=node.tag,
+                    attrs={k: v for k, v in node.attrs.items()},
+                    content=ToLegacy(node.content))
+  elif isinstance(node, document.Document):
+    return Document(title=ToLegacy(node.title),
+                    subtitle=ToLegacy(node.subtitle),
+                    copyright=ToLegacy(node.copyright),
+                    sections=[ToLegacy(s) for s in node.sections])
+  elif isinstance(node, document.Section):
+    return Section(title=ToLegacy(node.title), body=ToLegacy(node.body))
+  elif isinstance(node, document.Code):
+    return Code(content=ToLegacy(node.content))
+  elif isinstance(node, document.CodeBlock):
+    return CodeBlock(header=node.header and ToLegacy(node.header),
+                     body=ToLegacy(node.body))
+  elif isinstance(node, page.Prerendered):
+    return page.Prerendered(chunks=node.chunks, references=node.references)
+  else:
+    return node
+
+
+def Rebuild(node: Any) -> Any:
+  """Copy a frontend document or page fragment into a fresh compact IR.
+
+  Strings and references are shared with the original, as in ToLegacy, so
+  the two copies can be compared like for like.
+  """
+  if isinstance(node, (document.MixedContent, page.MixedContent)):
+    return type(node)([Rebuild(p) for p in node.parts])
+  elif isinstance(node, (document.HTMLNode, page.HTMLNode)):
+    return type(node)(tag=node.tag, attrs=dict(node.attrs.items()),
+                      content=Rebuild(node.content))
+  elif isinstance(node, document.Document):
+    return document.Document(title=Rebuild(node.title),
+                             subtitle=Rebuild(node.subtitle),
+                             copyright=Rebuild(node.copyright),
+                             sections=[Rebuild(s) for s in node.sections])
+  elif isinstance(node, document.Section):
+    return document.Section(title=Rebuild(node.title), body=Rebuild(node.body))
+  elif isinstance(node, document.Code):
+    return document.Code(content=Rebuild(node.content), lang=node.lang)
+  elif isinstance(node, document.CodeBlock):
+    return document.CodeBlock(header=node.header and Rebuild(node.header),
+                              body=Rebuild(node.body), lang=node.lang)
+  elif isinstance(node, page.Prerendered):
+    return page.Prerendered(chunks=node.chunks, references=node.references)
+  else:
+    return node
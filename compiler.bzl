@@ -88,28 +88,118 @@ def _workspace(ctx, label):
 def _runfiles_path(ctx, file):
     return paths.normalize(_workspace(ctx, file.owner) + "/" + file.short_path)
 
-def _make_manifest(ctx, assets, documents, index, output_root):
-    m_assets = ["Asset(%s, %s)" % (repr(_runfiles_path(ctx, f)), repr(f.path)) for f in assets.to_list()]
-    m_docs = ["Document(%s, %s)" % (repr(_runfiles_path(ctx, f)), repr(f.path)) for f in documents.to_list()]
-    m_inputs = '\n'.join(
-        ["["] + ["        " + x + "," for x in m_assets + m_docs] + ["    ]"])
-    m_contents = """Manifest(
-    inputs={m_inputs},
-    index={m_index},
-    output_root={m_output_root})
-""".format(
-        m_inputs = m_inputs,
-        m_index = repr(_runfiles_path(ctx, index)),
-        m_output_root = repr(output_root))
-    manifest = ctx.actions.declare_file(ctx.label.name + '_manifest')
+def _asset_record(f):
+    return json.encode(["Asset", f.short_path, f.path])
+
+def _document_record(f):
+    return json.encode(["Document", f.short_path, f.path])
+
+def _make_manifest(ctx, name, assets, documents, index, output_root, pages = {}):
+    """Write a manifest for the compiler.
+
+    The manifest is in JSON lines: a header object, then one
+    [kind, src_url, path] array per input. Input src_urls are short paths,
+    relative to the header's src_root. The content is expanded from the
+    depsets when the file is written, not during analysis.
+
+    Args:
+        ctx: The rule context.
+        name: Suffix distinguishing this manifest from the rule's others.
+        assets: A depset of asset files.
+        documents: A depset of documents to be rendered by the compiler.
+        index: The index document.
+        output_root: The directory in the output holding the site.
+        pages: A dict from documents to their precompiled pages. Documents
+            listed here are emitted as Page inputs instead of Documents.
+    """
+    content = ctx.actions.args()
+    content.set_param_file_format("multiline")
+    content.add(json.encode({
+        "version": 1,
+        "src_root": ctx.workspace_name,
+        "index": _runfiles_path(ctx, index),
+        "output_root": output_root,
+    }))
+    content.add_all(assets, map_each = _asset_record)
+    if pages:
+        # The documents were flattened to compile them anyway
+        content.add_all([
+            json.encode(["Page", f.short_path, pages[f].path]) if f in pages else _document_record(f)
+            for f in documents.to_list()
+        ])
+    else:
+        content.add_all(documents, map_each = _document_record)
+    manifest = ctx.actions.declare_file(ctx.label.name + '_' + name)
     ctx.actions.write(
-        content = m_contents,
+        content = content,
         output = manifest,
     )
     return manifest
 
 SiteInfo = provider(fields = ["tarball"])
 
+# Lets the compiler run as a persistent worker, which keeps its interpreter,
+# imports and include cache warm between actions.
+_WORKER_REQUIREMENTS = {
+    "requires-worker-protocol": "json",
+    "supports-workers": "1",
+}
+
+def _compiler_args(ctx):
+    """Create the arguments of a compiler action.
+
+    Workers take their per-action arguments from a params file, so the
+    arguments are always passed through one.
+    """
+    args = ctx.actions.args()
+    args.use_param_file("@%s", use_always = True)
+    args.set_param_file_format("multiline")
+    return args
+
+def _add_common_args(ctx, args, inputs, stamp = True):
+    if ctx.attr.nav:
+        inputs.append(ctx.file.nav)
+        args.add("--nav", ctx.file.nav)
+    if stamp:
+        info_file = ctx.attr.build_info[BuildInfo].info_file
+        version_file = ctx.attr.build_info[BuildInfo].version_file
+        inputs.extend([info_file, version_file])
+        args.add("--info_file", info_file)
+        args.add("--version_file", version_file)
+
+def _compile_document(ctx, doc, assets, index):
+    """Declare an action rendering one document to an intermediate page.
+
+    The page still holds unresolved references; it is linked by the site's
+    final action. Each document gets its own action so that editing one only
+    reruns that document's action and the link. Pages are hermetic: the build
+    stamp is filled in by the link, so the action does not read the status
+    files and its result stays cached from one commit to the next.
+    """
+    doc_path = _runfiles_path(ctx, doc)
+    manifest = _make_manifest(
+        ctx, "manifests/" + doc_path, assets, depset(), index,
+        ctx.attr.output_root)
+    page = ctx.actions.declare_file(ctx.label.name + "_pages/" + doc_path + ".page")
+    args = _compiler_args(ctx)
+    inputs = [manifest, doc]
+    args.add("--mode", "compile")
+    args.add("--manifest", manifest)
+    args.add("--document", doc)
+    args.add("--output", page)
+    args.add("--hermetic_pages")
+    _add_common_args(ctx, args, inputs, stamp = False)
+    ctx.actions.run(
+        executable = ctx.executable._compiler,
+        arguments = [args],
+        inputs = depset(inputs, transitive = [assets]),
+        outputs = [page],
+        mnemonic = "CompileDocument",
+        execution_requirements = _WORKER_REQUIREMENTS,
+        progress_message = "Compiling %s" % doc_path,
+    )
+    return page
+
 def _site(ctx):
     merged = _merge_input_info(
         [ctx.attr._compiler[InputInfo]]
@@ -120,25 +210,30 @@ def _site(ctx):
     if len(indices) != 1:
         fail("Must provide one index document", ctx.attr.index)
     index = indices[0]
-    manifest = _make_manifest(ctx, assets, documents, index, ctx.attr.output_root)
-    info_file = ctx.attr.build_info[BuildInfo].info_file
-    version_file = ctx.attr.build_info[BuildInfo].version_file
-    args = ctx.actions.args()
-    inputs = [manifest, info_file, version_file]
+    pages = {}
+    for src in ctx.attr.srcs:
+        info = src[InputInfo]
+        for doc in info.documents.to_list():
+            if doc not in pages:
+                pages[doc] = _compile_document(ctx, doc, info.assets, index)
+    manifest = _make_manifest(
+        ctx, "manifest", assets, documents, index, ctx.attr.output_root,
+        pages = pages)
+    args = _compiler_args(ctx)
+    inputs = [manifest] + pages.values()
     args.add("--manifest", manifest)
-    if ctx.attr.nav:
-        inputs.append(ctx.file.nav)
-        args.add("--nav", ctx.file.nav)
     args.add("--output", ctx.outputs.out)
-    args.add("--info_file", info_file)
-    args.add("--version_file", version_file)
+    _add_common_args(ctx, args, inputs)
     ctx.actions.run(
         executable = ctx.executable._compiler,
         arguments = [args],
+        # Documents without a precompiled page are rendered when linking
         inputs = depset(
             inputs,
             transitive = [assets, documents]),
         outputs = [ctx.outputs.out],
+        mnemonic = "LinkSite",
+        execution_requirements = _WORKER_REQUIREMENTS,
     )
     return [SiteInfo(tarball = ctx.outputs.out)]
 
@@ -1,21 +1,156 @@
+import collections
+import concurrent.futures
+import contextlib
 import functools
+import itertools
+import json
 import os
-import subprocess
-import tempfile
-from typing import NamedTuple, Sequence, Union
+import pickle
+import posixpath
+import sys
+import time
+import traceback
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, TextIO, Tuple, Union
 
 from absl import app
 from absl import flags
+from absl import logging
 
+from web_compiler.backend import archive
+from web_compiler.backend import cache as cachelib
 from web_compiler.backend import linker
+from web_compiler.backend import materialize
+from web_compiler.backend import optimize
 from web_compiler.backend import page
+from web_compiler.backend import serving
 from web_compiler.backend.swiss import document as swissdoc
 from web_compiler.frontend import frontend
+from web_compiler.frontend import nav as navlib
+from web_compiler.tracing import tracing
+from web_compiler.watch import watch
 
 flags.DEFINE_string('manifest', None, 'TODO')
 flags.DEFINE_string('nav', None, 'TODO')
 flags.DEFINE_string('output', None, 'TODO')
-flags.mark_flags_as_required(['manifest', 'output'])
+flags.DEFINE_enum(
+    'mode', 'site', ['site', 'compile'],
+    'With "site", render the manifest\'s documents, link them with its assets '
+    'and pages and package the result. With "compile", render only '
+    '--document to an intermediate page for a later site build.')
+flags.DEFINE_string(
+    'document', None, 'Path of the document to render with --mode=compile.')
+flags.DEFINE_bool(
+    'hermetic_pages', False,
+    'Render pages with placeholders for the build stamp, filled in when the '
+    'site is linked, so that a rendered page depends only on its document and '
+    'stays the same, and cached, from one build to the next. The site is '
+    'unchanged. Pages compiled with this need no --info_file or '
+    '--version_file.')
+flags.DEFINE_bool(
+    'resource_hints', False,
+    'Add <link> hints to the head of every page: preloads of the nav icons '
+    'and prefetches of the pages the nav links to.')
+flags.DEFINE_integer(
+    'jobs', 1,
+    'Number of worker processes used to load and render documents. The '
+    'output is identical to a serial build regardless of this setting.',
+    lower_bound=1)
+flags.DEFINE_integer(
+    'compression_level', 6,
+    'Gzip compression level of the output tarball, from 0 (store '
+    'uncompressed) to 9.',
+    lower_bound=0, upper_bound=9)
+flags.DEFINE_bool(
+    'stream_documents', False,
+    'Parse documents incrementally, one top-level section at a time, so that '
+    'very large documents are never held as a whole element tree.')
+flags.DEFINE_bool(
+    'pipeline', False,
+    'Write each page as soon as its document is rendered and release it, '
+    'rather than linking the whole site at the end, so that memory does not '
+    'grow with the number of documents. At most two pages per job are '
+    'rendered ahead of the writer. Tarball members are in document rather '
+    'than path order.')
+flags.DEFINE_integer(
+    'lazy_text_min_bytes', None,
+    'Leave text XIncludes of at least this many bytes, like large listings, '
+    'in their files until pages are written, and escape them from there a '
+    'chunk at a time, so that their size does not affect memory. Listings '
+    'that are highlighted are read as usual.',
+    lower_bound=0)
+flags.DEFINE_string(
+    'output_dir', None,
+    'Write the site into this directory instead of packaging it as --output. '
+    'Files of a previous build at the same paths are replaced.')
+flags.DEFINE_enum(
+    'asset_strategy', 'auto', materialize.STRATEGIES,
+    'How assets are placed in --output_dir. Strategies that the filesystem '
+    'does not support fall back to copying.')
+flags.DEFINE_bool(
+    'dedup_assets', False,
+    'Store assets with identical content once, linking the other copies to '
+    'it.')
+flags.DEFINE_bool(
+    'minify', False,
+    'Minify HTML pages: collapse whitespace outside of <pre>, and drop '
+    'redundant end tags and attribute quotes.')
+flags.DEFINE_bool(
+    'precompress', False,
+    'Write a gzipped .gz sibling of each HTML, CSS and SVG file, for servers '
+    'that serve precompressed files.')
+flags.DEFINE_bool(
+    'fingerprint_assets', False,
+    'Name each asset after a hash of its content, as in style.3f9a1c2e.css, '
+    'so that it can be served with a far-future cache lifetime. Pages refer '
+    'to the fingerprinted names. Not applied with --watch.')
+flags.DEFINE_integer(
+    'inline_max_bytes', 0,
+    'Inline assets of at most this many bytes where pages use them as images '
+    'or stylesheets, as data: URIs, and write no file for assets used only '
+    'that way; 0 to not inline. Not applied with --watch.',
+    lower_bound=0)
+flags.DEFINE_string(
+    'serving_manifest', None,
+    'Write what a static server needs to know of each output file to this '
+    'file: its size, a strong ETag, content type and cache class (immutable '
+    'for fingerprinted assets, revalidated otherwise). Not written with '
+    '--watch.')
+flags.DEFINE_enum(
+    'serving_manifest_format', 'json', sorted(serving.WRITERS),
+    'Format of --serving_manifest: "json", an nginx map of the ETag and '
+    'Cache-Control headers, or a _headers file for Netlify or Cloudflare '
+    'Pages. The nginx map and _headers give weak ETags, since one header '
+    'covers both a file and its .gz sibling.')
+flags.DEFINE_string(
+    'cache_dir', None,
+    'Directory of a persistent cache of rendered pages. Unchanged documents '
+    'are not parsed or rendered again when the cache is warm.')
+flags.DEFINE_integer(
+    'cache_max_bytes', 1 << 30,
+    'Size above which the least recently used cache entries are evicted.',
+    lower_bound=0)
+flags.DEFINE_string(
+    'trace_out', None,
+    'Write a Chrome trace of the build to this file, and a plain-text summary '
+    'of the slowest spans next to it with a .txt suffix.')
+flags.DEFINE_bool(
+    'trace_memory', False,
+    'Record the tracemalloc peak of each traced span. This slows the build '
+    'down considerably.')
+flags.DEFINE_integer(
+    'trace_top', 20, 'Number of slowest spans listed in the trace summary.')
+flags.DEFINE_bool(
+    'watch', False,
+    'Build the site into --output_dir, then keep running and update it as its '
+    'inputs change, rendering only the documents that read changed files.')
+flags.DEFINE_integer(
+    'port', 8000,
+    'With --watch, serve --output_dir on this local port; 0 to not serve.',
+    lower_bound=0)
+flags.DEFINE_float(
+    'watch_interval', 0.1, 'Seconds between polls for changes with --watch.')
+flags.mark_flags_as_required(['manifest'])
+flags.mark_flags_as_mutual_exclusive(['output', 'output_dir'], required=True)
 
 FLAGS = flags.FLAGS
 
@@ -30,7 +165,13 @@ class Document(NamedTuple):
     path: str
 
 
-LinkerInput = Union[Asset, Document]
+class Page(NamedTuple):
+    """A document already rendered by --mode=compile."""
+    src_url: str
+    path: str
+
+
+LinkerInput = Union[Asset, Document, Page]
 
 
 class Manifest(NamedTuple):
@@ -39,47 +180,698 @@ class Manifest(NamedTuple):
     output_root: str
 
 
+_INPUT_KINDS = {t.__name__: t for t in (Asset, Document, Page)}
+
+# Number of manifest records decoded at once
+_MANIFEST_CHUNK_SIZE = 4096
+
+
+def _ReadInputs(f: TextIO, path: str, src_root: str) -> List[LinkerInput]:
+    """Read the input records that follow the header of manifest file f."""
+    inputs = []
+    while True:
+        lines = [l for l in itertools.islice(f, _MANIFEST_CHUNK_SIZE)
+                 if l.strip()]
+        if not lines:
+            return inputs
+        # One decoder call per chunk rather than per record
+        records = json.loads('[' + ','.join(lines) + ']')
+        inputs.extend(_Input(path, src_root, *r) for r in records)
+
+
+def _Input(path: str, src_root: str, kind: str, src_url: str, input_path: str
+           ) -> LinkerInput:
+    try:
+        input_type = _INPUT_KINDS[kind]
+    except KeyError:
+        raise ValueError(f'{path}: unknown input kind {kind!r}') from None
+    if src_url.startswith('../'):
+        # A file in another repository, given relative to this one
+        src_url = posixpath.normpath(posixpath.join(src_root, src_url))
+    elif src_root:
+        src_url = f'{src_root}/{src_url}'
+    return input_type(src_url, input_path)
+
+
+MANIFEST_VERSION = 1
+
+
+def ReadManifest(path: str) -> Manifest:
+    """Read a manifest written by compiler.bzl.
+
+    The manifest is in JSON lines. The first line is a header object giving
+    the format version, the src_url of the index document, the output root and
+    a src_root. Every other line is an array [kind, src_url, path] naming an
+    Asset, Document or Page input, where src_url is relative to src_root.
+
+    The inputs are read into a list, decoding records a chunk at a time, and
+    are not streamed: a build goes over them several times (to map paths,
+    add resources and pick out documents), and reading the file again for
+    each pass cost more than the list of a few small tuples per input.
+    """
+    with open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('version') != MANIFEST_VERSION:
+            raise ValueError(
+                f'{path}: unsupported manifest version '
+                f'{header.get("version")!r}')
+        inputs = _ReadInputs(f, path, header.get('src_root', ''))
+    return Manifest(
+        inputs=inputs,
+        index=header['index'],
+        output_root=header['output_root'])
+
+
+class RenderContext(NamedTuple):
+    loader: frontend.Loader
+    nav_items: Sequence[navlib.NavItem]
+    cache: Optional[cachelib.Cache] = None
+    chrome: Optional[swissdoc.Chrome] = None
+
+
+def _PageKey(ctx: RenderContext, doc_key: str,
+             includes: Sequence[str]) -> Optional[str]:
+    parts = [doc_key.encode()]
+    for href in includes:
+        try:
+            path = ctx.loader.Resolve(href)
+            digest = cachelib.HashFile(path)
+        except (KeyError, OSError):
+            return None
+        parts.extend([href.encode(), digest])
+        if ctx.loader.lazy_text_min_bytes is not None:
+            # Pages may refer to text left in the file by its path
+            parts.append(path.encode())
+    return ctx.cache.key(*parts)
+
+
+def RenderDocument(ctx: RenderContext, path: str, *,
+                   includes: Optional[Set[str]] = None) -> page.Fragment:
+    """Load and render a document, going through the cache if there is one.
+
+    Cached pages are found in two steps. The document's own content selects
+    the list of XIncludes it resolved when it was last rendered, and the page
+    is then keyed on the document together with the current content of each of
+    those includes.
+
+    If includes is given, the hrefs of the XIncludes the page was rendered
+    from are added to it.
+    """
+    if ctx.cache is None:
+        doc = ctx.loader.LoadDocument(path, includes=includes)
+        with tracing.Span('Render'):
+            return swissdoc.RenderDocument(
+                doc, nav_items=ctx.nav_items, chrome=ctx.chrome)
+    doc_key = ctx.cache.key(b'document', cachelib.HashFile(path))
+    cached_includes = ctx.cache.get(doc_key)
+    if cached_includes is not None:
+        page_key = _PageKey(ctx, doc_key, cached_includes)
+        fragment = page_key and ctx.cache.get(page_key)
+        if fragment is not None:
+            tracing.Annotate(cache_hit=True)
+            if includes is not None:
+                includes.update(cached_includes)
+            return fragment
+    resolved = set()
+    doc = ctx.loader.LoadDocument(path, includes=resolved)
+    with tracing.Span('Render'):
+        fragment = swissdoc.RenderDocument(
+            doc, nav_items=ctx.nav_items, chrome=ctx.chrome)
+    if includes is not None:
+        includes.update(resolved)
+    page_key = _PageKey(ctx, doc_key, sorted(resolved))
+    if page_key is not None:
+        ctx.cache.put(doc_key, sorted(resolved))
+        ctx.cache.put(page_key, fragment)
+    return fragment
+
+
+# Per-process state for the worker pool; see _InitWorker.
+_worker_context: Optional[RenderContext] = None
+
+
+def _InitWorker(flag_args: List[str], ctx: RenderContext):
+    global _worker_context
+    # Workers started with the spawn method do not inherit parsed flags, and
+    # the backend reads some of them (e.g. --info_file) while rendering.
+    if not FLAGS.is_parsed():
+        FLAGS(['compiler'] + flag_args, known_only=True)
+    # Forked workers inherit the parent's tracer and its events
+    tracing.Disable()
+    if FLAGS.trace_out:
+        tracing.Enable(memory=FLAGS.trace_memory)
+    _worker_context = ctx
+
+
+def _TracedRender(ctx: RenderContext, doc: Document) -> page.Fragment:
+    with tracing.Span('document', src_url=doc.src_url):
+        return RenderDocument(ctx, doc.path)
+
+
+def _RenderInWorker(doc: Document) -> Tuple[page.Fragment, List[Any]]:
+    fragment = _TracedRender(_worker_context, doc)
+    tracer = tracing.Current()
+    return fragment, tracer.drain() if tracer else []
+
+
+def _MapBounded(pool: concurrent.futures.Executor, fn: Callable,
+                items: Iterable[Any], max_pending: int) -> Iterator[Any]:
+    """Like pool.map, with at most max_pending items submitted and unconsumed.
+
+    A consumer that falls behind holds back the submission of new items, so
+    results do not pile up in memory.
+    """
+    pending = collections.deque()
+    for item in items:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(pool.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def RenderDocuments(ctx: RenderContext, docs: Sequence[Document], *,
+                    jobs: int = 1,
+                    max_pending: Optional[int] = None
+                    ) -> Iterator[page.Fragment]:
+    """Load and render documents, yielding fragments in the order of docs.
+
+    With jobs > 1 the work is spread over a process pool; results are still
+    yielded in input order so the caller observes the same sequence as a serial
+    build. Spans traced in the workers are merged into this process's tracer.
+    With max_pending, at most that many documents are rendered ahead of the
+    consumer.
+    """
+    if jobs <= 1 or len(docs) <= 1:
+        for doc in docs:
+            yield _TracedRender(ctx, doc)
+        return
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(jobs, len(docs)),
+            initializer=_InitWorker,
+            initargs=(FLAGS.flags_into_string().splitlines(), ctx)) as pool:
+        if max_pending is None:
+            chunksize = max(1, len(docs) // (4 * jobs))
+            results = pool.map(_RenderInWorker, docs, chunksize=chunksize)
+        else:
+            results = _MapBounded(pool, _RenderInWorker, docs, max_pending)
+        tracer = tracing.Current()
+        for fragment, events in results:
+            if tracer:
+                tracer.extend(events)
+            yield fragment
+
+
+# Shared by every build in this process, so that a persistent worker or
+# --watch reads unchanged XIncludes and nav files once.
+_include_cache = frontend.IncludeCache()
+# Likewise for the content hashes of fingerprinted assets
+_file_hasher = cachelib.FileHasher()
+
+
+def _MakeRenderContext(manifest: Manifest, *,
+                       nav_includes: Optional[Set[str]] = None
+                       ) -> RenderContext:
+    load = frontend.Loader({i.src_url: i.path for i in manifest.inputs},
+                           stream=FLAGS.stream_documents,
+                           include_cache=_include_cache,
+                           lazy_text_min_bytes=FLAGS.lazy_text_min_bytes)
+    if FLAGS.nav:
+        nav = load.LoadNav(FLAGS.nav, includes=nav_includes)
+    else:
+        nav = []
+    if FLAGS.cache_dir:
+        salt = '\n'.join([
+            swissdoc.RenderStamp(hermetic=FLAGS.hermetic_pages,
+                                 resource_hints=FLAGS.resource_hints),
+            repr(nav),
+            repr(FLAGS.lazy_text_min_bytes)]).encode()
+        cache = cachelib.Cache(
+            FLAGS.cache_dir, max_bytes=FLAGS.cache_max_bytes, salt=salt)
+    else:
+        cache = None
+    return RenderContext(loader=load, nav_items=nav, cache=cache,
+                         chrome=swissdoc.BuildChrome(
+                             nav, hermetic=FLAGS.hermetic_pages,
+                             resource_hints=FLAGS.resource_hints))
+
+
+def WritePage(fragment: page.Fragment, path: str):
+    with open(path, 'wb') as f:
+        pickle.dump(fragment, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def ReadPage(path: str) -> page.Fragment:
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _RequireBuildStamp(what: str):
+    # Checked up front, since the stamp is otherwise only read partway
+    # through rendering or linking
+    if not FLAGS.info_file or not FLAGS.version_file:
+        raise app.UsageError(f'{what} requires --info_file and --version_file')
+
+
+def CompileMain(manifest: Manifest):
+    """Render FLAGS.document to an intermediate page file at FLAGS.output.
+
+    References in the page are left unresolved; a later site build lists the
+    page as a Page input to link it.
+    """
+    if not FLAGS.document:
+        raise app.UsageError('--mode=compile requires --document')
+    if FLAGS.output_dir:
+        raise app.UsageError('--mode=compile writes a page to --output, not '
+                             '--output_dir')
+    if not FLAGS.hermetic_pages:
+        _RequireBuildStamp('--mode=compile without --hermetic_pages')
+    ctx = _MakeRenderContext(manifest)
+    WritePage(RenderDocument(ctx, FLAGS.document), FLAGS.output)
+
+
+@contextlib.contextmanager
+def _OpenOutput() -> Iterator[Union[linker.DirectoryOutput, archive.TarOutput]]:
+    if FLAGS.output_dir:
+        yield linker.DirectoryOutput(materialize.Materializer(
+            FLAGS.asset_strategy, dedup=FLAGS.dedup_assets), replace=True)
+    else:
+        # Written beside the output and renamed onto it once complete, so a
+        # failed build never leaves a partial archive at --output
+        tmp = os.path.join(os.path.dirname(FLAGS.output),
+                           f'.{os.path.basename(FLAGS.output)}.tmp-{os.getpid()}')
+        try:
+            with open(tmp, 'wb') as f, archive.TarOutput(
+                    f, compression_level=FLAGS.compression_level,
+                    dedup=FLAGS.dedup_assets) as out:
+                yield out
+            os.replace(tmp, FLAGS.output)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp)
+            raise
+
+
+def _OptimizeOutput(out: linker.Output) -> linker.Output:
+    if not (FLAGS.minify or FLAGS.precompress):
+        return out
+    return optimize.OptimizingOutput(
+        out, minify=FLAGS.minify, precompress=FLAGS.precompress)
+
+
+def _LogPageStats(stats: Dict[str, optimize.PageStats]):
+    for path, s in sorted(stats.items()):
+        logging.vlog(
+            1, 'Page %s: %d bytes, %d after minifying (%d saved), %s gzipped',
+            path, s.bytes_in, s.bytes_out, s.bytes_saved,
+            'not' if s.gzip_bytes is None else s.gzip_bytes)
+    if stats:
+        logging.vlog(
+            1, 'Pages: %d bytes saved by minifying %d pages',
+            sum(s.bytes_saved for s in stats.values()), len(stats))
+
+
+def _LogAssetStats(stats: Dict[str, materialize.StrategyStats]):
+    for strategy, s in sorted(stats.items()):
+        logging.vlog(
+            1, 'Assets via %s: %d files, %d bytes (%d newly stored), %.1f MB/s',
+            strategy, s.files, s.bytes, s.stored_bytes, s.throughput / 1e6)
+
+
+def _AddResources(
+        link: linker.Linker, manifest: Manifest,
+        pages: Callable[[Union[Document, Page]], linker.Resource],
+) -> Set[linker.Reference]:
+    """Add the manifest's inputs to link and return the site's entry points.
+
+    pages gives the resource of each Document and Page input.
+    """
+    documents = set()
+    for i in manifest.inputs:
+        basename = os.path.basename(i.src_url)
+        if isinstance(i, Asset):
+            link.add_resource(
+                ref=linker.Reference(i.src_url),
+                out=os.path.join(manifest.output_root, 'assets', basename),
+                resource=linker.StaticResource(i.path))
+        elif isinstance(i, (Document, Page)):
+            base, _ = os.path.splitext(basename)
+            ref = linker.Reference(i.src_url)
+            link.add_resource(
+                ref=ref,
+                out=os.path.join(manifest.output_root, base + '.html'),
+                resource=pages(i))
+            documents.add(ref)
+        else:
+            raise TypeError(i)
+    index = linker.Reference('_index')
+    link.add_resource(
+        ref=index,
+        out=os.path.join(manifest.output_root, 'index.html'),
+        resource=linker.LinkResource(linker.Reference(manifest.index)))
+    return documents | {index}
+
+
+class _PendingPage(linker.Resource):
+    """Stands in for a page of a pipelined build before and after it is written.
+
+    Only the references of a written page are kept, for the closure.
+    """
+
+    def __init__(self, references: FrozenSet[
+            Union[linker.Reference, linker.Embed]] = frozenset()):
+        super().__init__()
+        self._references = references
+
+    def get_references(self) -> Set[Union[linker.Reference, linker.Embed]]:
+        return set(self._references)
+
+    def populate_fs(self, path: str, link: linker.Linker):
+        raise AssertionError(f'{path} is written when it is rendered')
+
+
+def _LinkPipelined(link: linker.Linker, manifest: Manifest):
+    """Link the site, writing each page as soon as it is rendered.
+
+    Output paths come from the manifest alone, so every reference resolves
+    before any document is rendered. A page is written when its fragment
+    arrives, and only its references are kept. The rest of the closure is
+    written once all pages are.
+    """
+    entries = _AddResources(link, manifest, lambda i: _PendingPage())
+    if FLAGS.fingerprint_assets:
+        # Pages refer to fingerprinted names, so name every asset up front
+        link.fingerprint({linker.Reference(i.src_url) for i in manifest.inputs})
+    written = set()
+
+    def Write(i: Union[Document, Page], fragment: page.Fragment):
+        ref = linker.Reference(i.src_url)
+        resource = page.PageResource(fragment)
+        link.replace_resource(ref, resource)
+        link.populate({ref})
+        link.replace_resource(
+            ref, _PendingPage(frozenset(resource.get_references())))
+        written.add(ref)
+
+    docs = []
+    for i in manifest.inputs:
+        if isinstance(i, Document):
+            docs.append(i)
+        elif isinstance(i, Page):
+            Write(i, ReadPage(i.path))
+    if docs:
+        ctx = _MakeRenderContext(manifest)
+        for doc, fragment in zip(docs, RenderDocuments(
+                ctx, docs, jobs=FLAGS.jobs, max_pending=2 * FLAGS.jobs)):
+            Write(doc, fragment)
+        if ctx.cache is not None:
+            ctx.cache.evict()
+    with tracing.Span('link'):
+        link.populate(link.closure(entries) - written)
+
+
+def _Link(link: linker.Linker, manifest: Manifest):
+    """Render the whole site, then link it."""
+    docs = []
+    fragments: Dict[Union[Document, Page], page.Fragment] = dict()
+    for i in manifest.inputs:
+        if isinstance(i, Document):
+            docs.append(i)
+        elif isinstance(i, Page):
+            fragments[i] = ReadPage(i.path)
+    if docs:
+        ctx = _MakeRenderContext(manifest)
+        fragments.update(zip(
+            docs, RenderDocuments(ctx, docs, jobs=FLAGS.jobs)))
+        if ctx.cache is not None:
+            ctx.cache.evict()
+    entries = _AddResources(
+        link, manifest, lambda i: page.PageResource(fragments[i]))
+    with tracing.Span('link'):
+        link.link(entries)
+
+
+def _WriteServingManifest(output: serving.ServingOutput,
+                          link: linker.Linker):
+    files = output.files(immutable=link.fingerprinted().__contains__)
+    with open(FLAGS.serving_manifest, 'wt') as f:
+        serving.WRITERS[FLAGS.serving_manifest_format](files, f)
+
+
+def SiteMain(manifest: Manifest):
+    _RequireBuildStamp('--mode=site')
+    with _OpenOutput() as out:
+        output = served = None
+        if FLAGS.serving_manifest:
+            # Innermost, to see the files as they are finally written
+            output = served = serving.ServingOutput(
+                out, FLAGS.output_dir or '', hasher=_file_hasher)
+        output = _OptimizeOutput(output or out)
+        link = linker.Linker(
+            FLAGS.output_dir or '', output=output,
+            fingerprint=FLAGS.fingerprint_assets, hasher=_file_hasher,
+            inline_max_bytes=FLAGS.inline_max_bytes,
+            stamps=swissdoc.BuildStamps())
+        if FLAGS.pipeline:
+            _LinkPipelined(link, manifest)
+        else:
+            _Link(link, manifest)
+        if served is not None:
+            _WriteServingManifest(served, link)
+        if isinstance(output, optimize.OptimizingOutput):
+            _LogPageStats(output.stats)
+        if isinstance(out, linker.DirectoryOutput):
+            _LogAssetStats(out.materializer.stats)
+        else:
+            _LogAssetStats(out.stats)
+
+
+class WatchedSite(object):
+    """A site build kept in memory and updated in place as its inputs change.
+
+    Documents are parsed and rendered once. After that, a document is rendered
+    again only when its own file or one of the XIncludes it resolved changes,
+    and only the output files of changed inputs are written. The nav is part
+    of every page, so a change to it renders all documents again.
+    """
+
+    def __init__(self, manifest: Manifest, output_dir: str):
+        super().__init__()
+        self._manifest = manifest
+        self._docs = [i for i in manifest.inputs if isinstance(i, Document)]
+        self._link = linker.Linker(output_dir, output=_OptimizeOutput(
+            linker.DirectoryOutput(
+                materialize.Materializer(FLAGS.asset_strategy),
+                replace=True)), stamps=swissdoc.BuildStamps())
+        self._ctx: Optional[RenderContext] = None
+        self._nav_paths: Set[str] = set()
+        # Files each document was last rendered from, other than its own
+        self._include_paths: Dict[Document, Set[str]] = dict()
+        # Documents whose last render failed, to retry on the next change
+        self._failed: Set[Document] = set()
+        self._written: Set[linker.Reference] = set()
+
+    def _load_context(self):
+        nav_includes = set()
+        ctx = _MakeRenderContext(self._manifest, nav_includes=nav_includes)
+        self._ctx = ctx
+        self._nav_paths = {ctx.loader.Resolve(h) for h in nav_includes}
+        if FLAGS.nav:
+            self._nav_paths.add(FLAGS.nav)
+
+    def _render(self, doc: Document) -> page.Fragment:
+        includes = set()
+        try:
+            with tracing.Span('document', src_url=doc.src_url):
+                return RenderDocument(self._ctx, doc.path, includes=includes)
+        finally:
+            # Watch whatever was read, even if rendering then failed
+            self._include_paths[doc] = {
+                self._ctx.loader.Resolve(h) for h in includes}
+
+    def paths(self) -> Set[str]:
+        """The files the site is currently built from."""
+        paths = {i.path for i in self._manifest.inputs} | self._nav_paths
+        for include_paths in self._include_paths.values():
+            paths |= include_paths
+        return paths
+
+    def build(self):
+        self._load_context()
+        fragments: Dict[Union[Document, Page], page.Fragment] = dict()
+        for i in self._manifest.inputs:
+            if isinstance(i, Document):
+                fragments[i] = self._render(i)
+            elif isinstance(i, Page):
+                fragments[i] = ReadPage(i.path)
+        if self._ctx.cache is not None:
+            self._ctx.cache.evict()
+        entries = _AddResources(
+            self._link, self._manifest,
+            lambda i: page.PageResource(fragments[i]))
+        self._written = self._link.closure(entries)
+        self._link.populate(self._written)
+
+    def update(self, changed: Set[str]):
+        """Bring the output up to date after the files in changed changed.
+
+        Documents that fail to load or render keep their previous page and
+        are retried on the next update.
+        """
+        start = time.perf_counter()
+        if changed & self._nav_paths:
+            self._load_context()
+            dirty = set(self._docs)
+        else:
+            dirty = {d for d in self._docs
+                     if d.path in changed or self._include_paths[d] & changed}
+        dirty |= self._failed
+        self._failed = set()
+        refs = set()
+        for i in self._manifest.inputs:
+            ref = linker.Reference(i.src_url)
+            try:
+                if isinstance(i, Document) and i in dirty:
+                    fragment = self._render(i)
+                elif isinstance(i, Page) and i.path in changed:
+                    fragment = ReadPage(i.path)
+                else:
+                    if isinstance(i, Asset) and i.path in changed:
+                        refs.add(ref)
+                    continue
+            except Exception:
+                logging.exception('Failed to update %s', i.src_url)
+                if isinstance(i, Document):
+                    self._failed.add(i)
+                continue
+            self._link.replace_resource(ref, page.PageResource(fragment))
+            refs.add(ref)
+        refs &= self._written
+        # Changed pages may reference resources nothing referenced before
+        added = self._link.closure(refs) - self._written
+        self._link.populate(refs | added)
+        self._written |= added
+        logging.info('Updated %d files in %.0f ms', len(refs | added),
+                     (time.perf_counter() - start) * 1e3)
+
+
+def WatchMain(manifest: Manifest):
+    """Build the site into FLAGS.output_dir and keep it up to date."""
+    if not FLAGS.output_dir:
+        raise app.UsageError('--watch requires --output_dir')
+    _RequireBuildStamp('--watch')
+    site = WatchedSite(manifest, FLAGS.output_dir)
+    site.build()
+    watcher = watch.FileWatcher(site.paths())
+    server = None
+    if FLAGS.port:
+        server = watch.Serve(FLAGS.output_dir, port=FLAGS.port)
+        logging.info('Serving http://localhost:%d/%s/index.html', FLAGS.port,
+                     manifest.output_root)
+    try:
+        while True:
+            site.update(watcher.wait(FLAGS.watch_interval))
+            watcher.add(site.paths())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.shutdown()
+
+
+def Build():
+    """Run the build described by the parsed flags."""
+    if FLAGS.trace_out:
+        tracing.Enable(memory=FLAGS.trace_memory)
+    try:
+        with tracing.Span('manifest', path=FLAGS.manifest):
+            manifest = ReadManifest(FLAGS.manifest)
+        if FLAGS.mode == 'compile':
+            CompileMain(manifest)
+        elif FLAGS.watch:
+            WatchMain(manifest)
+        else:
+            SiteMain(manifest)
+    finally:
+        tracer = tracing.Current()
+        if tracer:
+            tracing.Disable()
+            tracer.write(FLAGS.trace_out)
+            with open(FLAGS.trace_out + '.txt', 'wt') as f:
+                f.write(tracer.summary(FLAGS.trace_top))
+
+
+def _ExpandParamFiles(args: List[str]) -> List[str]:
+    """Replace each @file argument with the arguments in file, one per line.
+
+    This is how Bazel passes arguments through a params file in the
+    "multiline" format.
+    """
+    expanded = []
+    for arg in args:
+        if arg.startswith('@'):
+            with open(arg[1:], 'rt') as f:
+                expanded.extend(f.read().splitlines())
+        else:
+            expanded.append(arg)
+    return expanded
+
+
+def _HandleWorkRequest(args: List[str]) -> Tuple[int, str]:
+    # Start every request from the flags' defaults, so that no flag set by
+    # one build carries over to the next.
+    FLAGS.unparse_flags()
+    try:
+        FLAGS([sys.argv[0]] + _ExpandParamFiles(args))
+        Build()
+    except (flags.Error, app.UsageError) as e:
+        return 2, f'{e}\n'
+    except Exception:
+        return 1, traceback.format_exc()
+    return 0, ''
+
+
+def WorkerMain():
+    """Serve Bazel persistent worker requests until stdin is closed.
+
+    Requests and responses use Bazel's JSON worker protocol, one message per
+    line. Each request is a full build run with its own flags. What persists
+    between requests are the imported modules and the include cache.
+    """
+    responses = sys.stdout
+    # Anything printed while building must not corrupt the protocol stream
+    with contextlib.redirect_stdout(sys.stderr):
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            exit_code, output = _HandleWorkRequest(
+                request.get('arguments', []))
+            responses.write(json.dumps({
+                'exitCode': exit_code,
+                'output': output,
+                'requestId': request.get('requestId', 0),
+            }) + '\n')
+            responses.flush()
+
+
+def _ParseFlags(argv: List[str]) -> List[str]:
+    argv = argv[:1] + _ExpandParamFiles(argv[1:])
+    if '--persistent_worker' in argv[1:]:
+        # Flags come with each work request instead; see WorkerMain
+        FLAGS.mark_as_parsed()
+        return argv
+    return app.parse_flags_with_usage(argv)
+
+
 def main(argv):
+    if '--persistent_worker' in argv[1:]:
+        WorkerMain()
+        return
     if len(argv) > 1:
         raise app.UsageError('TODO')
-    with open(FLAGS.manifest, 'rt') as f:
-        manifest = eval(f.read(), globals())
-    assert isinstance(manifest, Manifest)
-    with tempfile.TemporaryDirectory() as d:
-        load = frontend.Loader({i.src_url: i.path for i in manifest.inputs})
-        link = linker.Linker(d)
-        if FLAGS.nav:
-            nav = load.LoadNav(FLAGS.nav)
-        else:
-            nav = []
-        documents = set()
-        for i in manifest.inputs:
-            basename = os.path.basename(i.src_url)
-            if isinstance(i, Asset):
-                link.add_resource(
-                    ref=linker.Reference(i.src_url),
-                    out=os.path.join(manifest.output_root, 'assets', basename),
-                    resource=linker.StaticResource(i.path))
-            elif isinstance(i, Document):
-                base, _ = os.path.splitext(basename)
-                ref = linker.Reference(i.src_url)
-                doc = load.LoadDocument(i.path)
-                link.add_resource(
-                    ref=ref,
-                    out=os.path.join(manifest.output_root, base + '.html'),
-                    resource=page.PageResource(
-                        swissdoc.RenderDocument(doc, nav_items=nav)))
-                documents.add(ref)
-            else:
-                raise TypeError(i)
-        index = linker.Reference('_index')
-        link.add_resource(
-            ref=index,
-            out=os.path.join(manifest.output_root, 'index.html'),
-            resource=linker.LinkResource(linker.Reference(manifest.index)))
-        link.link(documents | {index})
-        subprocess.check_call(['tar', '-czf', FLAGS.output, '-C', d, manifest.output_root])
+    Build()
 
 
 if __name__ == '__main__':
-    app.run(main)
+    app.run(main, flags_parser=_ParseFlags)
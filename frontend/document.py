@@ -1,32 +1,94 @@
-from typing import Dict, List, NamedTuple, Optional, Text, Union
+import io
+from typing import Mapping, Optional, Sequence, Text, Union
 
+from web_compiler.backend import compact
 
-class MixedContent(NamedTuple):
-  parts: List[Union[Text, 'MixedContent', 'HTMLNode', 'Code', 'CodeBlock']]
 
+class MixedContent(compact.Node):
+  __slots__ = ('parts',)
+  parts: Sequence[Union[Text, 'MixedContent', 'HTMLNode', 'Code', 'CodeBlock',
+                        'TextFile']]
 
-class Document(NamedTuple):
+  def __init__(self, parts):
+    self.parts = compact.Children(parts)
+
+
+class Document(compact.Node):
+  __slots__ = ('title', 'subtitle', 'copyright', 'sections')
   title: MixedContent
   subtitle: MixedContent
   copyright: MixedContent
-  sections: List['Section']
+  sections: Sequence['Section']
+
+  def __init__(self, title, subtitle, copyright, sections):
+    self.title = title
+    self.subtitle = subtitle
+    self.copyright = copyright
+    self.sections = compact.Children(sections)
 
 
-class Section(NamedTuple):
+class Section(compact.Node):
+  __slots__ = ('title', 'body')
   title: MixedContent
   body: MixedContent
 
+  def __init__(self, title, body):
+    self.title = title
+    self.body = body
 
-class HTMLNode(NamedTuple):
+
+class HTMLNode(compact.Node):
+  __slots__ = ('tag', 'attrs', 'content')
   tag: Text
-  attrs: Dict[Text, Text]
+  attrs: Mapping[Text, Text]
   content: MixedContent
 
+  def __init__(self, tag, attrs, content):
+    self.tag = compact.Intern(tag)
+    self.attrs = compact.FreezeAttrs(attrs)
+    self.content = content
+
 
-class Code(NamedTuple):
+class Code(compact.Node):
+  __slots__ = ('content', 'lang')
   content: MixedContent
+  lang: Optional[Text]
+
+  def __init__(self, content, lang=None):
+    self.content = content
+    self.lang = compact.Intern(lang)
 
 
-class CodeBlock(NamedTuple):
+class CodeBlock(compact.Node):
+  __slots__ = ('header', 'body', 'lang')
   header: Optional[MixedContent]
   body: MixedContent
+  lang: Optional[Text]
+
+  def __init__(self, header, body, lang=None):
+    self.header = header
+    self.body = body
+    self.lang = compact.Intern(lang)
+
+
+class TextFile(compact.Node):
+  """Text left in the file it was included from, from byte start to end."""
+  __slots__ = ('path', 'start', 'end', 'encoding')
+  path: Text
+  start: int
+  end: int
+  encoding: Text
+
+  def __init__(self, path, start, end, encoding):
+    self.path = path
+    self.start = start
+    self.end = end
+    self.encoding = compact.Intern(encoding)
+
+  def read(self) -> Text:
+    """Read the text, translating newlines as a text-mode file would."""
+    with open(self.path, 'rb') as f:
+      f.seek(self.start)
+      data = f.read(self.end - self.start)
+    with io.TextIOWrapper(io.BytesIO(data), encoding=self.encoding) as f:
+      return f.read()
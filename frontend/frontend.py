@@ -1,29 +1,264 @@
-from typing import Dict, List
+import collections
+import copy
+import functools
+import os
+import threading
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
 from xml.etree import ElementInclude
 from xml.etree import ElementTree as ET
 
 from web_compiler.frontend import document
 from web_compiler.frontend import parser
 from web_compiler.frontend import nav
+from web_compiler.tracing import tracing
+
+
+class IncludeCacheStats(NamedTuple):
+  hits: int
+  misses: int
+
+
+# Inode, size and mtime of an included file when it was read
+_FileSignature = Tuple[int, int, int]
+# Path, parse mode and encoding of an include
+_IncludeKey = Tuple[str, str, Optional[str]]
+
+# Total size of the files whose contents an IncludeCache keeps by default
+_CACHE_MAX_BYTES = 64 << 20
+# Largest text include an IncludeCache keeps by default. Larger listings are
+# read again each time; see Loader's lazy_text_min_bytes to not hold them.
+_CACHE_MAX_TEXT_BYTES = 1 << 20
+
+
+class IncludeCache(object):
+  """XInclude targets, parsed once and shared between Loaders.
+
+  Entries are keyed by file path and checked against the file's inode, size
+  and mtime each time they are used, so a cache can outlive any one build (in
+  a persistent worker, say) and files that changed are read again. Text
+  includes are reused as-is, and XML includes are handed out as deep copies
+  since ElementInclude modifies the included tree while expanding it. The
+  cache is guarded by a lock so it can be shared between threads.
+
+  Entries are kept for files up to max_bytes in total, counted by file size,
+  and the least recently used go first. Text includes larger than
+  max_text_bytes are not kept at all.
+  """
+
+  def __init__(self, max_bytes: int = _CACHE_MAX_BYTES, *,
+               max_text_bytes: int = _CACHE_MAX_TEXT_BYTES):
+    super().__init__()
+    self._max_bytes = max_bytes
+    self._max_text_bytes = max_text_bytes
+    self._lock = threading.Lock()
+    self._entries: 'collections.OrderedDict[_IncludeKey, Tuple[_FileSignature, Union[str, ET.Element]]]' = (
+      collections.OrderedDict())
+    self._bytes = 0
+    self._hits = 0
+    self._misses = 0
+
+  @property
+  def stats(self) -> IncludeCacheStats:
+    with self._lock:
+      return IncludeCacheStats(hits=self._hits, misses=self._misses)
+
+  def Load(self, path: str, parse: str,
+           encoding: Optional[str] = None) -> Union[str, ET.Element]:
+    st = os.stat(path)
+    signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+    key = (path, parse, encoding)
+    data = None
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[0] == signature:
+        self._entries.move_to_end(key)
+        data = entry[1]
+        self._hits += 1
+    if data is None:
+      with tracing.Span('XInclude', path=path, bytes_in=st.st_size):
+        data = ElementInclude.default_loader(path, parse, encoding)
+      limit = self._max_text_bytes if parse == 'text' else self._max_bytes
+      with self._lock:
+        self._misses += 1
+        stale = self._entries.pop(key, None)
+        if stale is not None:
+          self._bytes -= stale[0][1]
+        if st.st_size <= limit:
+          self._entries[key] = (signature, data)
+          self._bytes += st.st_size
+        while self._bytes > self._max_bytes:
+          _, (evicted, _) = self._entries.popitem(last=False)
+          self._bytes -= evicted[1]
+    if isinstance(data, ET.Element):
+      return copy.deepcopy(data)
+    return data
 
 
 class Loader(object):
+  """Loads documents and nav files, resolving XIncludes through a path map.
+
+  Included files, and nav files themselves, are read through include_cache,
+  which defaults to one private to the Loader. When a Loader is pickled for a
+  worker process it starts with an empty private cache there.
 
-  def __init__(self, path_map: Dict[str, str]):
+  With stream, LoadDocument parses documents section by section; see
+  StreamDocument.
+
+  With lazy_text_min_bytes, text XIncludes of files at least that large are
+  not read. They are parsed to document.TextFile parts that refer to the
+  file, so that a large listing is read only as its page is written.
+  """
+
+  def __init__(self, path_map: Dict[str, str], *, stream: bool = False,
+               include_cache: Optional[IncludeCache] = None,
+               lazy_text_min_bytes: Optional[int] = None):
     super().__init__()
     self._path_map = path_map
+    self._stream = stream
+    self._include_cache = include_cache or IncludeCache()
+    self._lazy_text_min_bytes = lazy_text_min_bytes
+
+  def __getstate__(self):
+    return {'_path_map': self._path_map, '_stream': self._stream,
+            '_lazy_text_min_bytes': self._lazy_text_min_bytes}
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._include_cache = IncludeCache()
+
+  @property
+  def lazy_text_min_bytes(self) -> Optional[int]:
+    return self._lazy_text_min_bytes
+
+  @property
+  def include_cache_stats(self) -> IncludeCacheStats:
+    return self._include_cache.stats
+
+  def Resolve(self, href: str) -> str:
+    return self._path_map[href]
+
+  def _loader(self, href, parse, encoding=None, *, includes=None):
+    if includes is not None:
+      includes.add(href)
+    data = self._include_cache.Load(self._path_map[href], parse, encoding)
+    if parse == 'xml':
+      # Loaded as a copy, so it can be rewritten
+      holder = ET.Element('holder')
+      holder.append(data)
+      self._DeferTextIncludes(holder, includes)
+      data = holder[0]
+    return data
+
+  def _DeferTextIncludes(self, root: ET.Element,
+                         includes: Optional[Set[str]]):
+    """Replace large text XIncludes under root with TEXT_FILE_TAG elements."""
+    if self._lazy_text_min_bytes is None:
+      return
+    for parent in root.iter():
+      for i, e in enumerate(parent):
+        if (e.tag != ElementInclude.XINCLUDE_INCLUDE
+            or e.get('parse') != 'text' or e.get('href') not in self._path_map):
+          continue
+        path = self._path_map[e.get('href')]
+        size = os.path.getsize(path)
+        if size < self._lazy_text_min_bytes:
+          continue
+        if includes is not None:
+          includes.add(e.get('href'))
+        placeholder = ET.Element(parser.TEXT_FILE_TAG, {
+          'path': path, 'start': '0', 'end': str(size),
+          'encoding': e.get('encoding') or 'utf-8'})
+        placeholder.tail = e.tail
+        parent[i] = placeholder
+
+  def _Expand(self, root: ET.Element, includes: Optional[Set[str]]):
+    self._DeferTextIncludes(root, includes)
+    ElementInclude.include(
+      root, functools.partial(self._loader, includes=includes))
+
+  def LoadDocument(self, path: str, *,
+                   includes: Optional[Set[str]] = None) -> document.Document:
+    """Load a document, expanding XIncludes.
+
+    If includes is given, the href of every XInclude resolved while loading is
+    added to it.
+    """
+    if self._stream:
+      return self.StreamDocument(path, includes=includes)
+    with tracing.Span('LoadDocument', path=path) as span:
+      if tracing.Enabled():
+        span.set(bytes_in=os.path.getsize(path))
+      tree = ET.parse(path)
+      root = tree.getroot()
+      with tracing.Span('ExpandIncludes'):
+        self._Expand(root, includes)
+      with tracing.Span('Parse'):
+        return parser.ParseDocument(root)
+
+  @staticmethod
+  def _StreamParts(root: ET.Element, events: Iterator[Tuple[str, ET.Element]],
+                   expand: Callable[[ET.Element], None]
+                   ) -> Iterator[Union[str, ET.Element]]:
+    """Produce the top-level content of root as iterparse completes it.
+
+    Each child is produced once its end tag has been parsed and its XIncludes
+    have been expanded. When the consumer asks for the next part, the child is
+    detached from root and cleared, so only one top-level subtree is alive at
+    a time. Text between children is produced once the parser has seen it.
+    """
+    depth = 0
+    prev = None
+    for event, elem in events:
+      if event == 'start':
+        depth += 1
+        continue
+      depth -= 1
+      if depth > 0:
+        continue
+      # Either a child of root or root itself has ended; in both cases the
+      # text before it is now complete.
+      if prev is None:
+        if root.text:
+          yield root.text
+      else:
+        if prev.tail:
+          yield prev.tail
+        root.remove(prev)
+        prev.clear()
+      if elem is root:
+        return
+      # Expand through a holder, since ElementInclude only replaces children
+      # and elem may itself be an xi:include.
+      holder = ET.Element('holder')
+      holder.append(elem)
+      expand(holder)
+      if holder.text:
+        yield holder.text
+      for part in holder:
+        yield part
+      prev = elem
 
-  def _loader(self, href, parse, encoding=None):
-    return ElementInclude.default_loader(self._path_map[href], parse, encoding)
+  def StreamDocument(self, path: str, *,
+                     includes: Optional[Set[str]] = None) -> document.Document:
+    """Load a document incrementally with iterparse.
 
-  def LoadDocument(self, path: str) -> document.Document:
-    tree = ET.parse(path)
-    root = tree.getroot()
-    ElementInclude.include(root, self._loader)
-    return parser.ParseDocument(root)
+    Each top-level element is expanded, parsed and released as soon as it is
+    complete, so peak memory is bounded by the parsed document plus its
+    largest section rather than by the whole element tree. The result is the
+    same as LoadDocument's.
+    """
+    with tracing.Span('StreamDocument', path=path) as span:
+      if tracing.Enabled():
+        span.set(bytes_in=os.path.getsize(path))
+      events = ET.iterparse(path, events=('start', 'end'))
+      _, root = next(events)
+      parts = self._StreamParts(
+        root, events, functools.partial(self._Expand, includes=includes))
+      return parser.ParseDocumentStream(root, parts)
 
-  def LoadNav(self, path: str) -> List[nav.NavItem]:
-    tree = ET.parse(path)
-    root = tree.getroot()
-    ElementInclude.include(root, self._loader)
+  def LoadNav(self, path: str, *,
+              includes: Optional[Set[str]] = None) -> List[nav.NavItem]:
+    root = self._include_cache.Load(path, 'xml')
+    ElementInclude.include(
+      root, functools.partial(self._loader, includes=includes))
     return parser.ParseNav(root)
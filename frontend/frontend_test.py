@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+
+from absl.testing import absltest
+
+from web_compiler.frontend import frontend
+
+
+class IncludeCacheTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self._dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self._dir)
+
+  def _file(self, name: str, content: str) -> str:
+    path = os.path.join(self._dir, name)
+    with open(path, 'wt') as f:
+      f.write(content)
+    return path
+
+  def test_evicts_least_recently_used(self):
+    a = self._file('a', 'aaaaaa')
+    b = self._file('b', 'bbbbbb')
+    c = self._file('c', 'cccccc')
+    cache = frontend.IncludeCache(max_bytes=12)
+    cache.Load(a, 'text')
+    cache.Load(b, 'text')
+    cache.Load(a, 'text')
+    cache.Load(c, 'text')  # Evicts b, the least recently used
+    self.assertEqual(cache.stats, frontend.IncludeCacheStats(hits=1, misses=3))
+    self.assertEqual(cache.Load(a, 'text'), 'aaaaaa')
+    self.assertEqual(cache.Load(b, 'text'), 'bbbbbb')
+    self.assertEqual(cache.stats, frontend.IncludeCacheStats(hits=2, misses=4))
+
+  def test_does_not_keep_large_text(self):
+    path = self._file('large.txt', 'x' * 100)
+    cache = frontend.IncludeCache(max_text_bytes=10)
+    cache.Load(path, 'text')
+    cache.Load(path, 'text')
+    self.assertEqual(cache.stats, frontend.IncludeCacheStats(hits=0, misses=2))
+
+  def test_keeps_large_xml(self):
+    path = self._file('large.xml', f'<a>{"x" * 100}</a>')
+    cache = frontend.IncludeCache(max_text_bytes=10)
+    self.assertEqual(cache.Load(path, 'xml').text, 'x' * 100)
+    cache.Load(path, 'xml')
+    self.assertEqual(cache.stats, frontend.IncludeCacheStats(hits=1, misses=1))
+
+
+if __name__ == '__main__':
+  absltest.main()
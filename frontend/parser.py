@@ -1,7 +1,7 @@
 import sys
 import re
 import typing
-from typing import List
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
 from xml.etree import ElementTree as ET
 
 import more_itertools
@@ -23,6 +23,15 @@ class ParseError(Exception):
 
 class Parser(object):
 
+  def index_keys(self) -> Optional[Sequence[Hashable]]:
+    """Keys under which OneOf may dispatch to this parser without matching.
+
+    A parser that returns keys promises that it matches every part with one of
+    those keys (see PartKey) and nothing else. None means the parser has to be
+    tried with match().
+    """
+    return None
+
   def match(self, part):
     pass
 
@@ -47,6 +56,11 @@ class SimpleParser(Parser):
     self._match = match
     self._parse = parse
 
+  def index_keys(self):
+    if isinstance(self._match, Parser):
+      return self._match.index_keys()
+    return None
+
   def match(self, part):
     self._match(part)
 
@@ -54,30 +68,98 @@ class SimpleParser(Parser):
     return self._parse(part)
 
 
+# Key of text parts in OneOf's dispatch table
+TEXT_KEY = ('text',)
+
+
+def PartKey(part) -> Hashable:
+  """Get the dispatch key for a part: its tag for elements, else TEXT_KEY."""
+  if isinstance(part, ET.Element):
+    return ('tag', part.tag)
+  return TEXT_KEY
+
+
+def _NamespaceKey(key: Hashable) -> Optional[Hashable]:
+  if key[0] == 'tag' and isinstance(key[1], str) and key[1].startswith('{'):
+    return ('ns', key[1][1:key[1].find('}')])
+  return None
+
+
 class OneOf(Parser):
+  """Parse with the first of several alternatives that matches.
+
+  Alternatives that declare index_keys are looked up by the part's tag or
+  namespace instead of being tried in turn; the remaining alternatives are
+  tried in declaration order. The candidate list for each key is computed once
+  and cached, so the cache is bounded by the number of distinct tags rather
+  than by the number of parts parsed.
+  """
 
   def __init__(self, *parsers):
     super().__init__()
     self._parsers = parsers
-    self._matches = {}
+    self._index: Dict[Hashable, List[Tuple[int, Parser]]] = {}
+    self._unindexed: List[Tuple[int, Parser]] = []
+    for position, p in enumerate(parsers):
+      keys = p.index_keys()
+      if keys is None:
+        self._unindexed.append((position, p))
+      else:
+        for key in keys:
+          self._index.setdefault(key, []).append((position, p))
+    self._candidates: Dict[Hashable, List[Tuple[Parser, bool]]] = {}
 
-  def _show_errors(self, errors):
-    return ''.join('\n  ' + str(e) for e in errors)
+  def index_keys(self):
+    if self._unindexed:
+      return None
+    return list(self._index)
 
-  def match(self, part):
+  def _candidates_for(self, key: Hashable) -> List[Tuple[Parser, bool]]:
+    """Get the (parser, needs_match) pairs to try for a key, in order."""
+    try:
+      return self._candidates[key]
+    except KeyError:
+      pass
+    indexed = list(self._index.get(key, []))
+    ns_key = _NamespaceKey(key)
+    if ns_key is not None:
+      indexed.extend(self._index.get(ns_key, []))
+    candidates = sorted(
+      [(position, p, False) for position, p in indexed] +
+      [(position, p, True) for position, p in self._unindexed],
+      key=lambda c: c[0])
+    result = [(p, needs_match) for _, p, needs_match in candidates]
+    self._candidates[key] = result
+    return result
+
+  def _show_errors(self, part):
     errors = []
     for p in self._parsers:
       try:
         p.match(part)
-        self._matches[part] = p
-        return
       except ParseError as e:
-        errors.append((p, e))
+        errors.append(e)
+    return ''.join('\n  ' + str(e) for e in errors)
+
+  def _select(self, part) -> Parser:
+    for p, needs_match in self._candidates_for(PartKey(part)):
+      if not needs_match:
+        return p
+      try:
+        p.match(part)
+        return p
+      except ParseError:
         continue
-    raise ParseError(f'No parsers matched on {part}: {self._show_errors(errors)}')
+    raise ParseError(f'No parsers matched on {part}: {self._show_errors(part)}')
+
+  def match(self, part):
+    self._select(part)
 
   def parse(self, part):
-    return self._matches[part].parse(part)
+    return self._select(part).parse(part)
+
+  def __call__(self, part):
+    return self._select(part).parse(part)
 
 
 class XmlContentIterator(object):
@@ -93,8 +175,10 @@ class XmlContentIterator(object):
         result.append(child.tail)
     return result
 
-  def __init__(self, node, preserve_whitespace):
-    self._iter = iter(self._text_and_children(node))
+  def __init__(self, node, preserve_whitespace, parts=None):
+    if parts is None:
+      parts = self._text_and_children(node)
+    self._iter = iter(parts)
     self._preserve_whitespace = preserve_whitespace
 
   def __iter__(self):
@@ -117,11 +201,17 @@ class XmlContentIterator(object):
 
 
 class ParseContext(object):
+  """Sequential access to the content of a node.
 
-  def __init__(self, node, preserve_whitespace=False):
+  The content is normally the node's text and children. A streaming caller
+  may instead pass parts, an iterable producing the same text and elements
+  incrementally; see ParseDocumentStream.
+  """
+
+  def __init__(self, node, preserve_whitespace=False, parts=None):
     self._node = node
     self._iter = more_itertools.peekable(
-      XmlContentIterator(node, preserve_whitespace))
+      XmlContentIterator(node, preserve_whitespace, parts))
 
   def __enter__(self):
     return self
@@ -146,6 +236,11 @@ class ParseContext(object):
       result.append(parser(part))
     return result
 
+  def IterRest(self, parser):
+    """Like ExpectRest, but parse each part only when it is requested."""
+    for part in self._iter:
+      yield parser(part)
+
   def Optional(self, parser):
     try:
       result = parser(self._iter.peek())
@@ -164,6 +259,11 @@ class Node(Parser):
     super().__init__()
     self._match_tag = match_tag
 
+  def index_keys(self):
+    if isinstance(self._match_tag, (Tag, Namespace)):
+      return [self._match_tag.index_key]
+    return None
+
   def match(self, part):
     if not isinstance(part, ET.Element):
       raise ParseError(f'Expected node but got {part} of type {type(part)}')
@@ -173,6 +273,9 @@ class Node(Parser):
 
 class TextParser(Parser):
 
+  def index_keys(self):
+    return [TEXT_KEY]
+
   def match(self, part):
     if not isinstance(part, typing.Text):
       raise ParseError(f'Expected text but got {part} of type {type(part)}')
@@ -180,28 +283,64 @@ class TextParser(Parser):
 Text = TextParser()
 
 
+class Tag(object):
+  """Tag predicate matching one fully-qualified tag."""
+
+  def __init__(self, tag):
+    super().__init__()
+    self.tag = tag
+    self.index_key = ('tag', tag)
+
+  def __call__(self, tag):
+    return tag == self.tag
+
+
+class Namespace(object):
+  """Tag predicate matching any tag in a namespace."""
+
+  def __init__(self, uri):
+    super().__init__()
+    self._prefix = '{' + uri + '}'
+    self.index_key = ('ns', uri)
+
+  def __call__(self, tag):
+    return isinstance(tag, str) and tag.startswith(self._prefix)
+
+
 def BlogTag(name):
-  def match_tag(tag):
-    return tag == '{http://sj-olsen.com/blog}' + name
-  return match_tag
+  return Tag('{http://sj-olsen.com/blog}' + name)
+
 
+HTMLTag = Namespace('http://www.w3.org/1999/xhtml')
 
-def HTMLTag(tag):
-  return tag.startswith('{http://www.w3.org/1999/xhtml}')
+
+def _ParseDocumentContent(node, parts=None):
+  with ParseContext(node, parts=parts) as i:
+    title = ParseMixedContent(i.Expect(Node(BlogTag('title'))))
+    subtitle = ParseMixedContent(i.Expect(Node(BlogTag('subtitle'))))
+    copyright = ParseMixedContent(i.Expect(Node(BlogTag('copyright'))))
+    sections = list(i.IterRest(ParseDocumentSection))
+  return document.Document(
+    title=title,
+    subtitle=subtitle,
+    copyright=copyright,
+    sections=sections)
 
 
 @SimpleParser.Matching(Node(BlogTag('document')))
 def ParseDocument(node):
-  with ParseContext(node) as i:
-    title = i.Expect(Node(BlogTag('title')))
-    subtitle = i.Expect(Node(BlogTag('subtitle')))
-    copyright = i.Expect(Node(BlogTag('copyright')))
-    sections = i.ExpectRest(Node(BlogTag('section')))
-  return document.Document(
-    title=ParseMixedContent(title),
-    subtitle=ParseMixedContent(subtitle),
-    copyright=ParseMixedContent(copyright),
-    sections=list(map(ParseDocumentSection, sections)))
+  return _ParseDocumentContent(node)
+
+
+def ParseDocumentStream(node, parts):
+  """Parse a document whose top-level content is produced incrementally.
+
+  node is the document's root element, and parts produces its text and child
+  elements. Each child is parsed as soon as it is produced and before the next
+  one is requested, so the producer may discard it once it is asked for more.
+  """
+  ParseDocument.match(node)
+  return _ParseDocumentContent(node, parts)
 
 
 @SimpleParser.Matching(Node(BlogTag('section')))
@@ -218,7 +357,7 @@ def ParseDocumentSection(node):
 def ParseMixedContent(node):
   with ParseContext(node, preserve_whitespace=True) as i:
     return document.MixedContent(
-      parts=i.ExpectRest(OneOf(Text, ParseHTML, ParseCode, ParseCodeBlock)))
+      parts=i.ExpectRest(MixedContentPart))
 
 
 @SimpleParser.Matching(Node(HTMLTag))
@@ -232,7 +371,8 @@ def ParseHTML(node):
 @SimpleParser.Matching(Node(BlogTag('code')))
 def ParseCode(node):
   return document.Code(
-    content=ParseMixedContent(node))
+    content=ParseMixedContent(node),
+    lang=node.get('lang'))
 
 
 @SimpleParser.Matching(Node(BlogTag('code-block')))
@@ -242,7 +382,26 @@ def ParseCodeBlock(node):
     body = i.Expect(Node(BlogTag('body')))
   return document.CodeBlock(
     header=MapOptional(ParseMixedContent, header),
-    body=ParseMixedContent(body))
+    body=ParseMixedContent(body),
+    lang=node.get('lang'))
+
+
+# Stands in for a text XInclude that was left in its file; see
+# frontend.Loader. The element is never written by authors.
+TEXT_FILE_TAG = '{http://sj-olsen.com/web_compiler}text-file'
+
+
+@SimpleParser.Matching(Node(Tag(TEXT_FILE_TAG)))
+def ParseTextFile(node):
+  return document.TextFile(
+    path=node.attrib['path'],
+    start=int(node.attrib['start']),
+    end=int(node.attrib['end']),
+    encoding=node.attrib['encoding'])
+
+
+MixedContentPart = OneOf(
+  Text, ParseHTML, ParseCode, ParseCodeBlock, ParseTextFile)
 
 
 @SimpleParser.Matching(Node(BlogTag('nav')))
@@ -0,0 +1,187 @@
+import collections
+import json
+import os
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+
+class _NullSpan(object):
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+  def set(self, **args):
+    pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+
+  def __init__(self, tracer: 'Tracer', name: str, args: Dict[str, Any]):
+    self._tracer = tracer
+    self.name = name
+    self.args = args
+    self.start = 0
+    self.peak = 0
+
+  def set(self, **args):
+    self.args.update(args)
+
+  def __enter__(self):
+    self._tracer._push(self)
+    return self
+
+  def __exit__(self, *args):
+    self._tracer._pop(self)
+
+
+class Tracer(object):
+  """Records spans as Chrome trace events.
+
+  Spans are nested per thread. With memory tracing, each span also records the
+  tracemalloc peak reached while it was open; the peak of a span includes the
+  peaks of the spans nested in it.
+  """
+
+  def __init__(self, *, memory: bool = False):
+    super().__init__()
+    self._memory = memory
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self.events: List[Dict[str, Any]] = []
+    if memory and not tracemalloc.is_tracing():
+      tracemalloc.start()
+
+  def _stack(self) -> List[_Span]:
+    try:
+      return self._local.stack
+    except AttributeError:
+      self._local.stack = []
+      return self._local.stack
+
+  def _push(self, span: _Span):
+    stack = self._stack()
+    if self._memory:
+      _, peak = tracemalloc.get_traced_memory()
+      if stack:
+        stack[-1].peak = max(stack[-1].peak, peak)
+      tracemalloc.reset_peak()
+    stack.append(span)
+    span.start = time.monotonic_ns()
+
+  def _pop(self, span: _Span):
+    end = time.monotonic_ns()
+    stack = self._stack()
+    assert stack.pop() is span
+    event = {
+      'name': span.name,
+      'ph': 'X',
+      'ts': span.start / 1e3,
+      'dur': (end - span.start) / 1e3,
+      'pid': os.getpid(),
+      'tid': threading.get_ident(),
+      'args': span.args,
+    }
+    if self._memory:
+      _, peak = tracemalloc.get_traced_memory()
+      span.peak = max(span.peak, peak)
+      tracemalloc.reset_peak()
+      if stack:
+        stack[-1].peak = max(stack[-1].peak, span.peak)
+      span.args['tracemalloc_peak'] = span.peak
+    with self._lock:
+      self.events.append(event)
+
+  def drain(self) -> List[Dict[str, Any]]:
+    """Remove and return the events recorded so far."""
+    with self._lock:
+      events, self.events = self.events, []
+    return events
+
+  def extend(self, events: List[Dict[str, Any]]):
+    """Add events recorded by another tracer, e.g. in a worker process."""
+    with self._lock:
+      self.events.extend(events)
+
+  def write(self, path: str):
+    events = sorted(self.events, key=lambda e: e['ts'])
+    origin = events[0]['ts'] if events else 0
+    for e in events:
+      e['ts'] -= origin
+    with open(path, 'wt') as f:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+  def summary(self, top: int = 20) -> str:
+    """Summarize the recorded spans as text.
+
+    The summary gives per-name totals and the top slowest individual spans,
+    identified by their src_url or path where they have one.
+    """
+    totals: Dict[str, List[float]] = collections.defaultdict(lambda: [0, 0.0])
+    for e in self.events:
+      totals[e['name']][0] += 1
+      totals[e['name']][1] += e['dur']
+    lines = [f'{"span":32} {"count":>8} {"total ms":>12} {"mean ms":>10}']
+    for name, (count, dur) in sorted(totals.items(), key=lambda t: -t[1][1]):
+      lines.append(
+        f'{name:32} {count:8d} {dur / 1e3:12.3f} {dur / count / 1e3:10.3f}')
+    lines.append('')
+    lines.append(f'Slowest {top} spans:')
+    for e in sorted(self.events, key=lambda e: -e['dur'])[:top]:
+      args = e['args']
+      what = args.get('src_url') or args.get('path') or ''
+      extra = ''.join(f' {k}={args[k]}' for k in
+                      ('bytes_in', 'bytes_out', 'tracemalloc_peak')
+                      if k in args)
+      lines.append(f'{e["dur"] / 1e3:12.3f} ms  {e["name"]} {what}{extra}')
+    return '\n'.join(lines) + '\n'
+
+
+_tracer: Optional[Tracer] = None
+
+
+def Enable(*, memory: bool = False) -> Tracer:
+  global _tracer
+  _tracer = Tracer(memory=memory)
+  return _tracer
+
+
+def Disable():
+  global _tracer
+  _tracer = None
+
+
+def Current() -> Optional[Tracer]:
+  return _tracer
+
+
+def Enabled() -> bool:
+  """Whether spans are recorded; use to skip computing costly span args."""
+  return _tracer is not None
+
+
+def Span(name: str, **args):
+  """Open a span, for use as a context manager.
+
+  When tracing is disabled this returns a shared no-op span, so instrumented
+  code pays for little more than the call.
+  """
+  if _tracer is None:
+    return _NULL_SPAN
+  return _Span(_tracer, name, args)
+
+
+def Annotate(**args):
+  """Add arguments to the innermost open span on this thread, if any."""
+  if _tracer is None:
+    return
+  stack = _tracer._stack()
+  if stack:
+    stack[-1].set(**args)